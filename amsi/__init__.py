@@ -1,18 +1,37 @@
 r"""Arbitrary Marginal Simulation-based Inference"""
 
+import importlib
+
 from .criteria import (
     MSELoss,
     NLLWithLogitsLoss, FocalWithLogitsLoss, PeripheralWithLogitsLoss, QSWithLogitsLoss,
     RRLoss, SRLoss
 )
-from .datasets import OnlineDataset, OfflineDataset, LTEDataset
+from .datasets import OnlineDataset, OfflineDataset, LTEDataset, MemmapFile, open_samples
+from .coverage import hpd_percentiles
+from .histograms import Histogram, grid_histograms
 from .models import MLP, ResNet, NRE, MNRE, AMNRE
 from .optim import ReduceLROnPlateau
-from .samplers import TractableSampler, RESampler
+from .samplers import TractableSampler, RESampler, ImportanceSampler, effective_sample_size
 
 from .simulators import Simulator, LTERatio
-from .simulators.slcp import SLCP, MLCP
-from .simulators.gw import GW
-from .simulators.hh import HH
 
 from .masks import *
+
+
+SIMULATORS = {
+    'SLCP': '.simulators.slcp',
+    'MLCP': '.simulators.slcp',
+    'GW': '.simulators.gw',
+    'HH': '.simulators.hh',
+}
+
+
+def __getattr__(name: str):
+    r"""Lazily resolved simulator classes"""
+
+    if name in SIMULATORS:
+        module = importlib.import_module(SIMULATORS[name], __name__)
+        return getattr(module, name)
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
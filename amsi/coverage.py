@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+import torch
+import torch.nn as nn
+
+from torch.distributions import Distribution
+
+from typing import Callable, Iterable, Tuple
+
+from .histograms import conditioned_groups
+
+
+def hpd_percentiles(
+    model: nn.Module,
+    x: torch.Tensor,
+    theta_star: torch.Tensor,
+    masks: torch.BoolTensor,
+    prior: Callable[[torch.BoolTensor], Distribution],
+    samples: int = 2 ** 16,
+    batch_size: int = 2 ** 12,
+) -> Iterable[Tuple[torch.BoolTensor, torch.Tensor]]:
+    r"""Highest posterior density (HPD) percentiles of nominal parameters
+
+    The percentile of theta* is the posterior mass outside of the HPD region
+    whose boundary passes through theta*,
+
+        1 - P(p(theta | x) >= p(theta* | x)),
+
+    which is estimated by importance sampling with the prior as proposal, such
+    that the weights are the ratios r(theta | x). The prior samples are shared
+    by all observations and the masks of same size are evaluated together.
+
+    Args:
+        model: A ratio estimator (NRE, MNRE or AMNRE).
+        x: The (encoded) observations (K, X).
+        theta_star: The nominal parameters (K, D).
+        masks: The masks (M, D).
+        prior: The marginal prior of a mask.
+        samples: The number of prior samples.
+        batch_size: The number of prior samples per batch.
+
+    Yields:
+        Each mask and the percentiles (K,) of the observations.
+    """
+
+    x = x.unsqueeze(-2)  # broadcast over the samples
+    sizes = masks.sum(dim=-1)
+
+    for size in sizes.unique().tolist():
+        groups = conditioned_groups(model, x, masks[sizes == size], len(masks))
+
+        for group, f in groups:
+            indices = group.nonzero()[:, 1].view(len(group), size)
+            priors = [prior(m) for m in group]
+
+            # Nominal log-density
+            theta = theta_star[:, None, indices]  # (K, 1, G, k)
+
+            log_r = f(theta).squeeze(-2)
+            log_p_star = log_r + torch.stack([
+                p.log_prob(theta[..., j, :]).squeeze(-1) for j, p in enumerate(priors)
+            ], dim=-1)
+
+            # Importance sums, in log-space
+            total = torch.full_like(log_p_star, -float('inf'))
+            above = torch.full_like(log_p_star, -float('inf'))
+
+            for start in range(0, samples, batch_size):
+                n = min(batch_size, samples - start)
+
+                theta = torch.stack([p.sample((n,)) for p in priors], dim=-2)  # (N, G, k)
+                theta = theta.to(x)
+
+                log_r = f(theta)  # (K, N, G)
+                log_p = log_r + torch.stack([
+                    p.log_prob(theta[:, j]) for j, p in enumerate(priors)
+                ], dim=-1)
+
+                inside = log_p >= log_p_star.unsqueeze(-2)
+
+                total = torch.logaddexp(total, log_r.logsumexp(dim=-2))
+                above = torch.logaddexp(above, log_r.masked_fill(~inside, -float('inf')).logsumexp(dim=-2))
+
+            percentiles = 1. - (above - total).exp()
+
+            for j, mask in enumerate(group):
+                yield mask, percentiles[..., j]
@@ -1,15 +1,129 @@
 #!/usr/bin/env python
 
 import h5py
+import json
 import numpy as np
+import os
+import queue
+import threading
 import torch
 import torch.utils.data as data
 
-from typing import Tuple
+from itertools import islice
+from typing import Iterable, List, Tuple, Union
 
 from .simulators import Simulator
 
 
+class MemmapFile(object):
+    r"""Memory-mapped samples file
+
+    A directory of contiguous NumPy arrays (NPY), with a JSON header for the
+    attributes, which mimics the subset of `h5py.File` used for samples. Arrays
+    are memory-mapped, such that slicing them is zero-copy and reads go through
+    the OS page cache.
+
+    Args:
+        path: The directory path.
+        mode: The opening mode, either read ('r'), append ('a') or write ('w').
+    """
+
+    def __init__(self, path: str, mode: str = 'r'):
+        self.path = path
+        self.mode = mode
+        self.arrays = {}
+
+        if mode == 'w':
+            os.makedirs(path, exist_ok=True)
+
+            for name in os.listdir(path):
+                if name.endswith('.npy'):
+                    os.remove(os.path.join(path, name))
+
+            self.attrs = {}
+            self.flush()
+        else:
+            with open(self.header) as f:
+                self.attrs = json.load(f)
+
+    @property
+    def header(self) -> str:
+        return os.path.join(self.path, 'header.json')
+
+    def filename(self, name: str) -> str:
+        return os.path.join(self.path, name + '.npy')
+
+    def __contains__(self, name: str) -> bool:
+        return os.path.exists(self.filename(name))
+
+    def __getitem__(self, name: str) -> np.memmap:
+        if name not in self.arrays:
+            mmap_mode = 'c' if self.mode == 'r' else 'r+'  # copy-on-write if read-only
+            self.arrays[name] = np.load(self.filename(name), mmap_mode=mmap_mode)
+
+        return self.arrays[name]
+
+    def create_dataset(
+        self,
+        name: str,
+        shape: Tuple[int, ...] = None,
+        dtype: np.dtype = None,
+        data: np.ndarray = None,
+        **kwargs,  # ignored (e.g. chunks)
+    ) -> np.memmap:
+        if data is not None:
+            data = np.asarray(data)
+            shape, dtype = data.shape, data.dtype
+
+        array = np.lib.format.open_memmap(self.filename(name), mode='w+', dtype=dtype, shape=shape)
+
+        if data is not None:
+            array[...] = data
+
+        self.arrays[name] = array
+
+        return array
+
+    def create_dataset_like(self, name: str, other: np.ndarray, **kwargs) -> np.memmap:
+        return self.create_dataset(name, other.shape, other.dtype, **kwargs)
+
+    def flush(self) -> None:
+        for array in self.arrays.values():
+            if isinstance(array, np.memmap):
+                array.flush()
+
+        if self.mode != 'r':
+            attrs = {
+                key: val.tolist() if isinstance(val, np.ndarray) else val
+                for key, val in self.attrs.items()
+            }
+
+            # Atomic replacement, such that the header is never corrupted
+            with open(self.header + '.tmp', 'w') as f:
+                json.dump(attrs, f)
+
+            os.replace(self.header + '.tmp', self.header)
+
+    def close(self) -> None:
+        self.flush()
+        self.arrays.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def open_samples(filename: str, mode: str = 'r') -> Union[h5py.File, MemmapFile]:
+    r"""Opens a samples file, either HDF5 (H5) or memory-mapped (directory)"""
+
+    if os.path.isdir(filename):
+        return MemmapFile(filename, mode)
+    else:
+        return h5py.File(filename, mode)
+
+
 class OnlineDataset(data.IterableDataset):
     r"""Online Dataset"""
 
@@ -31,6 +145,11 @@ class OnlineDataset(data.IterableDataset):
         return (self.batch_size,)
 
     def __iter__(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        info = data.get_worker_info()
+
+        if info is not None:  # independent streams across workers
+            self.simulator.reseed(info.seed)
+
         while True:
             theta, x = self.simulator.sample(self.batch_shape)
 
@@ -41,27 +160,60 @@ class OnlineDataset(data.IterableDataset):
 
 
 class OfflineDataset(data.IterableDataset):
-    r"""Offline Dataset"""
+    r"""Offline Dataset
+
+    Args:
+        filename: The samples file, either HDF5 (H5) or memory-mapped (directory).
+        chunk_size: The number of samples loaded at once.
+        batch_size: The batch size.
+        device: The device of the batches.
+        prefetch: Whether to load the next chunk in a background thread,
+            while the batches of the current one are consumed.
+        device_resident: Whether to load the whole dataset on device once,
+            and shuffle it there. This removes host I/O from the iterations,
+            but requires the dataset to fit in device memory.
+
+    Note:
+        When iterated by several `DataLoader` workers, the chunks are split
+        between them and the file is opened lazily in each worker. Across
+        processes, see `shard`. Once seeded, the stream of batches only depends
+        on the seed, such that it can be resumed with `seek`.
+    """
 
     def __init__(
         self,
-        filename: str,  # H5
+        filename: str,  # H5 or directory
         chunk_size: str = 2 ** 18,  # 262144
         batch_size: int = 2 ** 10,  # 1024
         device: str = 'cpu',
+        prefetch: bool = False,
+        device_resident: bool = False,
     ):
         super().__init__()
 
-        self.f = h5py.File(filename, 'r')
+        self.filename = filename
+        self.pid, self.file = None, None
+
         self.noisy = 'noise' in self.f
 
+        self.ranges = complete_ranges(self.f, len(self))
         self.chunks = [
-            slice(i, min(i + chunk_size, len(self)))
-            for i in range(0, len(self), chunk_size)
+            slice(i, min(i + chunk_size, j))
+            for start, j in self.ranges
+            for i in range(start, j, chunk_size)
         ]
 
+        self.chunk_size = chunk_size
         self.batch_size = batch_size
         self.device = device
+        self.pin = torch.device(device).type == 'cuda'
+
+        self.prefetch = prefetch
+        self.buffers, self.events = None, [None, None]
+
+        self.rank, self.world_size = 0, 1
+        self.seed, self.epoch = None, 0
+        self.skip = {}  # per stream
 
         if 'mu' in self.f:
             self.mu = torch.from_numpy(self.f['mu'][:]).to(device)
@@ -73,10 +225,127 @@ class OfflineDataset(data.IterableDataset):
         else:
             self.isigma = None
 
+        # Device resident
+        self.resident = device_resident
+
+        if self.resident:
+            self.rows = torch.cat([
+                torch.arange(c.start, c.stop)
+                for c in self.chunks
+            ]).to(device)
+
+            self.theta = torch.from_numpy(self.f['theta'][:]).to(device)
+            self.x = torch.from_numpy(self.f['x'][:]).to(device)
+
+            if self.noisy:
+                self.noise = torch.from_numpy(self.f['noise'][:]).to(device)
+
+    @property
+    def f(self) -> Union[h5py.File, MemmapFile]:
+        if self.pid != os.getpid():  # HDF5 handles are not fork-safe
+            self.pid, self.file = os.getpid(), open_samples(self.filename)
+
+        return self.file
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['pid'], state['file'] = None, None
+        state['events'] = [None, None]
+
+        return state
+
     def __len__(self) -> int:
         return len(self.f['x'])
 
+    def shard(self, rank: int, world_size: int, seed: int = 0) -> None:
+        r"""Splits the chunks between processes
+
+        At each pass, the chunks are shuffled in the same order by all
+        processes, from the seed and the pass index, and each process iterates
+        over its share. The chunks are also shuffled and noised from the seed.
+        Device resident samples are split once.
+        """
+
+        self.rank, self.world_size = rank, world_size
+        self.seed, self.epoch = seed, 0
+
+        if self.resident:
+            self.rows = self.rows[rank::world_size]
+
+    def shard_chunks(self, epoch: int) -> List[slice]:
+        r"""Chunks of this process at a given pass, in order"""
+
+        rng = np.random.RandomState((self.seed + epoch) % 2 ** 32)
+        order = rng.permutation(len(self.chunks))
+
+        return [self.chunks[i] for i in order[self.rank::self.world_size]]
+
+    def length(self, size: int) -> int:
+        r"""Number of batches of a chunk of given size
+
+        A last batch of a single sample is dropped, as it holds no negative pair.
+        """
+
+        return size // self.batch_size + (size % self.batch_size > 1)
+
+    def seek(self, batches: int, workers: int = 0) -> None:
+        r"""Skips the first batches of the seeded stream, without loading them
+
+        The batches are counted as yielded by a `DataLoader` with `workers`
+        processes, which takes batches from its workers in turn. The skip only
+        applies to the next iteration of each stream.
+        """
+
+        assert self.seed is not None, "only a seeded dataset can seek"
+
+        W = max(workers, 1)
+
+        while True:
+            if self.resident:
+                sizes = [
+                    min(self.chunk_size, len(self.rows) - i)
+                    for i in range(0, len(self.rows), self.chunk_size)
+                ]
+            else:
+                sizes = [c.stop - c.start for c in self.shard_chunks(self.epoch)]
+
+            streams = [sum(map(self.length, sizes[w::W])) for w in range(W)]
+
+            if batches < sum(streams):
+                break
+
+            batches -= sum(streams)
+            self.epoch += 1
+
+        ## Turns over the streams that are not exhausted
+        skip = [0] * W
+
+        while batches > 0:
+            active = [w for w in range(W) if skip[w] < streams[w]]
+            turns = min(streams[w] - skip[w] for w in active)
+
+            if batches >= turns * len(active):
+                for w in active:
+                    skip[w] += turns
+
+                batches -= turns * len(active)
+            else:
+                q, r = divmod(batches, len(active))
+
+                for i, w in enumerate(active):
+                    skip[w] += q + (i < r)
+
+                batches = 0
+
+        self.skip = dict(enumerate(skip))
+
     def __getitem__(self, idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        if idx < 0:
+            idx += len(self)
+
+        if not any(i <= idx < j for i, j in self.ranges):
+            raise IndexError(f"sample {idx} is not in a complete chunk")
+
         if self.noisy:
             x = self.f['x'][idx] + self.f['noise'][idx]
         else:
@@ -93,35 +362,233 @@ class OfflineDataset(data.IterableDataset):
         return theta, self.normalize(x)
 
     def __iter__(self) -> Tuple[torch.Tensor, torch.Tensor]:
-        np.random.shuffle(self.chunks)
+        info = data.get_worker_info()
 
-        for chunk in self.chunks:
-            # Load
-            theta_chunk, x_chunk = self.f['theta'][chunk], self.f['x'][chunk]
+        skip = self.skip.pop(0 if info is None else info.id, 0)
 
-            ## Shuffle
-            order = np.random.permutation(len(x_chunk))
-            theta_chunk, x_chunk = theta_chunk[order], x_chunk[order]
+        if self.resident:
+            yield from islice(self.resident_batches(), skip, None)
+            return
 
-            ## Noise
-            if self.noisy:
-                noise_chunk = np.random.permutation(self.f['noise'][chunk])
-                x_chunk = x_chunk + noise_chunk
+        if self.seed is not None:  # same order in all processes, then split
+            chunks = self.shard_chunks(self.epoch)
+            seeds = [(self.seed, self.epoch, c.start) for c in chunks]
+
+            self.epoch += 1
+
+            if info is not None:
+                chunks = chunks[info.id::info.num_workers]
+                seeds = seeds[info.id::info.num_workers]
+                np.random.seed(info.seed % 2 ** 32)
+        elif info is None:
+            np.random.shuffle(self.chunks)
+            chunks = self.chunks
+        else:  # same order in all workers, then split
+            rng = np.random.RandomState((info.seed - info.id) % 2 ** 32)
+            order = rng.permutation(len(self.chunks))
+            chunks = [self.chunks[i] for i in order[info.id::info.num_workers]]
+
+            np.random.seed(info.seed % 2 ** 32)
+
+        if self.seed is None:
+            seeds = [None] * len(chunks)
 
-            # CUDA
-            theta_chunk, x_chunk = torch.from_numpy(theta_chunk), torch.from_numpy(x_chunk)
+        ## Skipped chunks
+        while chunks:
+            length = self.length(chunks[0].stop - chunks[0].start)
 
-            if self.device == 'cuda':
-                theta_chunk, x_chunk = theta_chunk.pin_memory(), x_chunk.pin_memory()
+            if skip < length:
+                break
 
+            skip -= length
+            chunks, seeds = chunks[1:], seeds[1:]
+
+        if self.prefetch:
+            chunks = self.prefetched(list(zip(chunks, seeds)))
+        else:
+            chunks = map(self.load, chunks, [None] * len(chunks), seeds)
+
+        for theta_chunk, x_chunk in chunks:
             # Batches
+            batches = zip(
+                theta_chunk.split(self.batch_size),
+                x_chunk.split(self.batch_size),
+            )
+
+            if skip > 0:
+                batches, skip = islice(batches, skip, None), 0
+
+            for theta, x in batches:
+                if len(theta) < 2:  # see `length`
+                    continue
+
+                theta = theta.to(self.device, non_blocking=True)
+                x = x.to(self.device, non_blocking=True)
+
+                yield theta, self.normalize(x)
+
+    def resident_batches(self) -> Iterable[Tuple[torch.Tensor, torch.Tensor]]:
+        r"""Shuffles the device resident dataset and yields views of its batches"""
+
+        if self.seed is None:
+            generator = None
+        else:
+            generator = torch.Generator(self.device)
+            generator.manual_seed(self.seed + self.epoch)
+            self.epoch += 1
+
+        rows = self.rows[torch.randperm(len(self.rows), generator=generator, device=self.device)]
+
+        if self.noisy:
+            noise_rows = self.rows[torch.randperm(len(self.rows), generator=generator, device=self.device)]
+
+        for i in range(0, len(rows), self.chunk_size):
+            chunk = rows[i:i + self.chunk_size]
+            theta_chunk, x_chunk = self.theta[chunk], self.x[chunk]
+
+            if self.noisy:
+                x_chunk = x_chunk + self.noise[noise_rows[i:i + self.chunk_size]]
+
+            x_chunk = self.normalize(x_chunk)
+
             for theta, x in zip(
                 theta_chunk.split(self.batch_size),
                 x_chunk.split(self.batch_size),
             ):
-                theta, x = theta.to(self.device), x.to(self.device)
+                if len(theta) > 1:
+                    yield theta, x
 
-                yield theta, self.normalize(x)
+    def load(
+        self,
+        chunk: slice,
+        buffers: Tuple[torch.Tensor, torch.Tensor] = None,
+        seed: Tuple[int, ...] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        r"""Loads, shuffles and noises a chunk
+
+        If buffers are provided, the chunk is copied into them. Otherwise, it is
+        pinned if the batches are sent to CUDA. If a seed is provided, the chunk
+        is shuffled and noised from it, instead of the global generator.
+        """
+
+        rng = np.random if seed is None else np.random.RandomState(seed)
+
+        # Load
+        theta_chunk, x_chunk = self.f['theta'][chunk], self.f['x'][chunk]
+
+        ## Shuffle
+        order = rng.permutation(len(x_chunk))
+        theta_chunk, x_chunk = theta_chunk[order], x_chunk[order]
+
+        ## Noise
+        if self.noisy:
+            noise_chunk = rng.permutation(self.f['noise'][chunk])
+            x_chunk = x_chunk + noise_chunk
+
+        theta_chunk, x_chunk = torch.from_numpy(theta_chunk), torch.from_numpy(x_chunk)
+
+        # CUDA
+        if buffers is not None:
+            theta_buff, x_buff = buffers
+            theta_chunk = theta_buff[:len(theta_chunk)].copy_(theta_chunk)
+            x_chunk = x_buff[:len(x_chunk)].copy_(x_chunk)
+        elif self.pin:
+            theta_chunk, x_chunk = theta_chunk.pin_memory(), x_chunk.pin_memory()
+
+        return theta_chunk, x_chunk
+
+    def prefetched(self, chunks: List[Tuple[slice, Tuple[int, ...]]]) -> Iterable[Tuple[torch.Tensor, torch.Tensor]]:
+        r"""Loads chunks in a background thread
+
+        If the batches are sent to CUDA, two pairs of pinned buffers are reused
+        across chunks: one is consumed while the other is filled. A buffer is
+        refilled only once the asynchronous copies of its batches have completed,
+        including those of the previous pass.
+        """
+
+        if not self.pin:
+            self.buffers = [None, None]
+        elif self.buffers is None:
+            length = max(c.stop - c.start for c in self.chunks)
+
+            if self.noisy:
+                x_dtype = np.result_type(self.f['x'].dtype, self.f['noise'].dtype)
+            else:
+                x_dtype = self.f['x'].dtype
+
+            self.buffers = [
+                tuple(
+                    torch.from_numpy(
+                        np.empty((length,) + shape, dtype=dtype)
+                    ).pin_memory()
+                    for shape, dtype in [
+                        (self.f['theta'].shape[1:], self.f['theta'].dtype),
+                        (self.f['x'].shape[1:], x_dtype),
+                    ]
+                ) for _ in range(2)
+            ]
+
+        free, full = queue.Queue(), queue.Queue()
+        stop = threading.Event()
+
+        for i, event in enumerate(self.events):
+            free.put((i, event))
+
+        def producer():
+            try:
+                for chunk, seed in chunks:
+                    item = free.get()
+
+                    if item is None or stop.is_set():
+                        return
+
+                    i, event = item
+
+                    if event is not None:
+                        event.synchronize()
+
+                    full.put((self.load(chunk, self.buffers[i], seed), i))
+            except BaseException as e:
+                full.put(e)
+            else:
+                full.put(None)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+
+        current = None
+
+        try:
+            while True:
+                item = full.get()
+
+                if item is None:
+                    break
+                elif isinstance(item, BaseException):
+                    raise item
+
+                chunk, current = item
+
+                yield chunk
+
+                if self.pin:
+                    event = torch.cuda.Event()
+                    event.record()
+                else:
+                    event = None
+
+                self.events[current] = event  # pending until the next pass, if any
+                free.put((current, event))
+
+                current = None
+        finally:
+            if self.pin and current is not None:  # pass interrupted within a chunk
+                self.events[current] = torch.cuda.Event()
+                self.events[current].record()
+
+            stop.set()
+            free.put(None)
+            thread.join()  # no write in the buffers after this pass
 
     def normalize(self, x: torch.Tensor):
         if self.mu is not None:
@@ -133,19 +600,73 @@ class OfflineDataset(data.IterableDataset):
         return x
 
 
-class LTEDataset(data.IterableDataset):
-    r"""Likelihood-To-Evidence (LTE) dataset"""
+def complete_ranges(f: Union[h5py.File, MemmapFile], length: int) -> List[Tuple[int, int]]:
+    r"""Ranges of samples whose chunks are complete
+
+    Files written by `sample.py` hold a ledger of the complete chunks, which
+    allows to skip those of an interrupted generation. Files without ledger
+    are assumed to be complete.
+    """
+
+    if 'complete' not in f.attrs:
+        return [(0, length)]
+
+    size = int(f.attrs['chunk_size'])
+    ranges = []
+
+    for c, done in enumerate(f.attrs['complete']):
+        if not done:
+            continue
+
+        i, j = c * size, min((c + 1) * size, length)
 
-    def __init__(self, dataset: data.IterableDataset):
+        if ranges and ranges[-1][1] == i:
+            ranges[-1] = (ranges[-1][0], j)
+        else:
+            ranges.append((i, j))
+
+    return ranges
+
+
+class LTEDataset(data.IterableDataset):
+    r"""Likelihood-To-Evidence (LTE) dataset
+
+    Args:
+        dataset: A dataset of pairs (theta, x).
+        negatives: The number K of marginal parameters per observation. If
+            1, theta' (N, D) is a permutation of theta. Otherwise, theta'
+            (K, N, D) are distinct rolls of theta, such that no joint pair
+            is a negative. If -1, use all in-batch pairs, that is K = N - 1.
+            K is at most N - 1 and batches of a single pair are skipped.
+    """
+
+    def __init__(self, dataset: data.IterableDataset, negatives: int = 1):
         super().__init__()
 
+        assert negatives >= 1 or negatives == -1, f'invalid number of negatives {negatives}'
+
         self.dataset = dataset
+        self.negatives = negatives
 
     def __len__(self) -> int:
         return len(self.dataset)
 
     def __iter__(self) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         for theta, x in self.dataset:
-            theta_prime = theta[torch.randperm(len(theta))]
+            N = len(theta)
+
+            if N < 2:  # no negative
+                continue
+
+            if self.negatives == 1:
+                theta_prime = theta[torch.randperm(N)]
+            else:
+                if self.negatives < 0:
+                    shifts = torch.arange(1, N)
+                else:
+                    shifts = torch.randperm(N - 1)[:self.negatives] + 1
+
+                indices = (torch.arange(N) - shifts[:, None]) % N
+                theta_prime = theta[indices.to(theta.device)]
 
             yield theta, theta_prime, x
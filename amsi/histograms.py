@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+import math
+import torch
+import torch.nn as nn
+
+from torch.distributions import Distribution
+
+from typing import Callable, Iterable, List, Tuple, Union
+
+from .models import NRE, MNRE, AMNRE
+
+
+def unravel_index(indices: torch.LongTensor, shape: List[int]) -> torch.LongTensor:
+    r"""Coordinates of flat indices in a grid of given shape"""
+
+    coords = []
+
+    for size in reversed(shape):
+        coords.append(indices % size)
+        indices = indices // size
+
+    return torch.stack(coords[::-1], dim=-1)
+
+
+def grid_cells(
+    bins: List[int],
+    low: torch.Tensor,  # (*, k)
+    high: torch.Tensor,  # (*, k)
+    start: int,
+    stop: int,
+) -> torch.Tensor:
+    r"""Centers of the grid cells with flat indices in [start, stop)
+
+    The cells are computed on the fly, instead of materializing the meshgrid.
+    Batched bounds lead to batched cells, with shape (stop - start, *, k).
+    """
+
+    indices = torch.arange(start, stop, device=low.device)
+    coords = unravel_index(indices, bins).to(low)
+    coords = coords.view(coords.shape[:1] + (1,) * (low.dim() - 1) + coords.shape[1:])
+
+    step = (high - low) / torch.tensor(bins).to(low)
+
+    return low + (coords + .5) * step
+
+
+def conditioned_groups(
+    model: nn.Module,
+    x: torch.Tensor,
+    masks: torch.BoolTensor,
+    group_size: int,
+) -> Iterable[Tuple[torch.BoolTensor, Callable[[torch.Tensor], torch.Tensor]]]:
+    r"""Groups of masks, with their estimators conditioned on x
+
+    The estimators of a group are evaluated in a single batched pass, by
+    stacking the heads of an MNRE or the masks of an AMNRE without
+    hypernetwork. Otherwise, the groups are single masks. The masks are
+    expected to have the same size.
+
+    Yields:
+        The masks (G, D) of the group and a callable mapping theta (N, G, k)
+        to log-ratios (*, N, G), for x of shape (*, 1, X).
+    """
+
+    if isinstance(model, MNRE) and model.groups is not None:
+        condition = lambda group: model.condition(x, group)
+    elif isinstance(model, AMNRE) and model.hyper is None:
+        condition = lambda group: amnre_condition(model, x, group)
+    else:
+        group_size = 1
+
+        def condition(group: torch.BoolTensor) -> Callable:
+            nre = model if isinstance(model, NRE) else model[group[0]]
+            g = nre.condition(x)
+
+            return lambda theta: g(theta.squeeze(-2)).unsqueeze(-1)
+
+    for i in range(0, len(masks), group_size):
+        group = masks[i:i + group_size]
+
+        # Conditioned lazily, as a hypernetwork reparametrizes in place
+        yield group, condition(group)
+
+
+def amnre_condition(
+    model: AMNRE,
+    x: torch.Tensor,
+    masks: torch.BoolTensor,  # (G, D)
+) -> Callable[[torch.Tensor], torch.Tensor]:
+    r"""AMNRE conditioned on x for several masks at once"""
+
+    masks = masks.to(x.device)
+
+    conditioned = model.condition(x.unsqueeze(-2), masks)
+    indices = masks.nonzero()[:, 1].view(len(masks), -1)
+
+    def f(theta: torch.Tensor) -> torch.Tensor:  # (N, G, k)
+        blank = theta.new_zeros(theta.shape[:-1] + masks.shape[-1:])
+        blank.scatter_(-1, indices.expand(theta.shape), theta)
+
+        return conditioned(blank)
+
+    return f
+
+
+def grid_histograms(
+    model: nn.Module,
+    x: torch.Tensor,
+    masks: torch.BoolTensor,
+    prior: Callable[[torch.BoolTensor], Distribution],
+    bins: int,
+    low: torch.Tensor,
+    high: torch.Tensor,
+    batch_size: int = 2 ** 12,
+    max_cells: int = 2 ** 24,
+) -> Iterable[Tuple[torch.BoolTensor, torch.Tensor]]:
+    r"""Posterior histograms of the masks, evaluated on their grids
+
+    The grid cells are streamed by batches and the masks of same size are
+    evaluated together, at most `max_cells` grid cells at a time.
+
+    Args:
+        model: A ratio estimator (NRE, MNRE or AMNRE).
+        x: The (encoded) observation (X,), or a batch of observations (*, X).
+        masks: The masks (M, D).
+        prior: The marginal prior of a mask.
+        bins: The number of bins per dimension.
+        low: The lower bounds (D,).
+        high: The upper bounds (D,).
+        batch_size: The number of cells per batch.
+        max_cells: The maximum number of cells held at once.
+
+    Yields:
+        Each mask and its histogram p(theta_a | x), scaled by the cell volume,
+        with shape (*, bins, ..., bins).
+    """
+
+    batch = x.shape[:-1]
+    x = x.unsqueeze(-2)  # broadcast over the cells
+
+    sizes = masks.sum(dim=-1)
+
+    for size in sizes.unique().tolist():
+        shape = [bins] * size
+        numel = bins ** size
+
+        group_size = max(1, max_cells // numel)
+        groups = conditioned_groups(model, x, masks[sizes == size], group_size)
+
+        for group, f in groups:
+            indices = group.nonzero()[:, 1].view(len(group), size)
+            l, h = low[indices], high[indices]  # (G, k)
+
+            priors = [prior(m) for m in group]
+            volume = ((h - l) / bins).prod(dim=-1)
+
+            hists = low.new_empty(batch + (numel, len(group)))
+
+            for start in range(0, numel, batch_size):
+                stop = min(start + batch_size, numel)
+                theta = grid_cells(shape, l, h, start, stop)  # (N, G, k)
+
+                log_p = f(theta) + torch.stack([
+                    p.log_prob(theta[:, j]) for j, p in enumerate(priors)
+                ], dim=-1)
+
+                hists[..., start:stop, :] = log_p.exp() * volume
+
+            for j, mask in enumerate(group):
+                yield mask, hists[..., j].reshape(batch + tuple(shape))
+
+
+class Histogram:
+    r"""Histogram accumulator, on the device of the samples
+
+    The histogram is dense when its number of cells does not exceed
+    `max_dense`. Otherwise, the bin indices of the samples are buffered and
+    periodically merged, by sorting, into a set of unique non-empty cells. A
+    single sparse tensor is built at the end.
+
+    Args:
+        bins: The number of bins per dimension.
+        low: The lower bounds (D,).
+        high: The upper bounds (D,).
+        max_dense: The maximum number of cells of a dense histogram.
+        buffer_size: The number of buffered samples before a merge.
+    """
+
+    def __init__(
+        self,
+        bins: Union[int, List[int]],
+        low: torch.Tensor,
+        high: torch.Tensor,
+        max_dense: int = 2 ** 24,
+        buffer_size: int = 2 ** 22,
+    ):
+        if type(bins) is int:
+            bins = [bins] * len(low)
+
+        self.bins = bins
+        self.low, self.high = low, high
+        self.numel = math.prod(bins)
+
+        self.dense = self.numel <= max_dense
+        self.flat = self.numel < 2 ** 63  # flat indices fit in int64
+        self.buffer_size = buffer_size
+
+        self.counts = None
+        self.keys, self.values = None, None
+        self.buffer, self.buffered = [], 0
+
+    def update(self, x: torch.Tensor, weights: torch.Tensor = None) -> None:
+        r"""Adds samples (*, D), with optional weights (*,)"""
+
+        x = x.reshape(-1, x.shape[-1])
+
+        if weights is None:
+            weights = torch.ones_like(x[:, 0])
+        else:
+            weights = weights.reshape(-1).to(x)
+
+        low, high = self.low.to(x), self.high.to(x)
+        bins = torch.tensor(self.bins, device=x.device)
+
+        # Bin indices
+        inside = torch.all((low <= x) & (x <= high), dim=-1)
+        x, weights = x[inside], weights[inside]
+
+        indices = ((x - low) / (high - low) * bins).long()
+        indices = torch.min(indices, bins - 1)
+
+        if self.flat:
+            strides = torch.tensor(
+                [math.prod(self.bins[i + 1:]) for i in range(len(self.bins))],
+                device=x.device,
+            )
+            indices = (indices * strides).sum(dim=-1)
+
+        # Accumulate
+        if self.dense:
+            if self.counts is None:
+                self.counts = weights.new_zeros(self.numel)
+
+            self.counts.index_add_(0, indices, weights)
+        else:
+            self.buffer.append((indices, weights))
+            self.buffered += len(indices)
+
+            if self.buffered >= self.buffer_size:
+                self.merge()
+
+    def rescale(self, factor: torch.Tensor) -> None:
+        r"""Multiplies the accumulated weights by a factor, scalar or per bin
+        (bins[0],) of the first dimension"""
+
+        factor = torch.as_tensor(factor).expand(self.bins[:1])
+
+        if self.dense:
+            if self.counts is not None:
+                self.counts.view(self.bins[0], -1).mul_(factor.to(self.counts)[:, None])
+
+            return
+
+        stride = math.prod(self.bins[1:])
+
+        def scaled(keys: torch.LongTensor, values: torch.Tensor) -> torch.Tensor:
+            first = keys // stride if self.flat else keys[:, 0]
+            return values * factor.to(values)[first]
+
+        if self.keys is not None:
+            self.values = scaled(self.keys, self.values)
+
+        self.buffer = [(keys, scaled(keys, values)) for keys, values in self.buffer]
+
+    def merge(self) -> None:
+        r"""Merges the buffered samples into the unique non-empty cells"""
+
+        if not self.buffer:
+            return
+
+        keys, values = zip(*self.buffer)
+        keys, values = list(keys), list(values)
+
+        if self.keys is not None:
+            keys.append(self.keys)
+            values.append(self.values)
+
+        keys, values = torch.cat(keys), torch.cat(values)
+
+        if self.flat:
+            self.keys, inverse = torch.unique(keys, return_inverse=True)
+        else:
+            self.keys, inverse = torch.unique(keys, dim=0, return_inverse=True)
+
+        self.values = values.new_zeros(len(self.keys)).index_add_(0, inverse, values)
+        self.buffer, self.buffered = [], 0
+
+    def result(self) -> torch.Tensor:
+        r"""Dense or (coalesced) sparse histogram"""
+
+        if self.dense:
+            if self.counts is None:
+                self.counts = self.low.new_zeros(self.numel)
+
+            return self.counts.view(self.bins)
+
+        self.merge()
+
+        if self.keys is None:
+            indices = self.low.new_zeros((len(self.bins), 0), dtype=torch.long)
+            values = self.low.new_zeros(0)
+        elif self.flat:
+            indices = unravel_index(self.keys, self.bins).t()
+            values = self.values
+        else:
+            indices = self.keys.t()
+            values = self.values
+
+        return torch.sparse_coo_tensor(indices, values, self.bins).coalesce()
@@ -16,7 +16,7 @@ class SelectionMask(nn.Module):
         self.register_buffer('masks', masks)
 
     def forward(self, shape: torch.Size = ()) -> torch.BoolTensor:
-        idx = torch.randint(len(self.masks), shape)
+        idx = torch.randint(len(self.masks), shape, device=self.masks.device)
         return self.masks[idx]
 
 
@@ -30,7 +30,7 @@ class UniformMask(nn.Module):
         self.register_buffer('powers', 2 ** torch.arange(size))
 
     def forward(self, shape: torch.Size = ()) -> torch.BoolTensor:
-        integers = torch.randint(1, 2 ** self.size, shape)
+        integers = torch.randint(1, 2 ** self.size, shape, device=self.powers.device)
         return bit_repr(integers, self.powers)
 
 
@@ -2,8 +2,9 @@
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
-from typing import List, Tuple, Union
+from typing import Callable, List, Tuple, Union
 
 
 ACTIVATIONS = {
@@ -230,6 +231,221 @@ class NRE(nn.Module):
         theta = self.normalize(theta)
         return self.mlp(torch.cat([theta, x], dim=-1)).squeeze(-1)
 
+    def condition(self, x: torch.Tensor) -> Callable[[torch.Tensor], torch.Tensor]:
+        r"""Estimator conditioned on a fixed x
+
+        theta ---> log r(theta | x)
+
+        The contribution of x to the first layer is computed once, and
+        broadcast as a bias at each call.
+        """
+
+        first, rest = self.mlp[0], self.mlp[1:]
+
+        k = first.in_features - x.size(-1)
+        weight = first.weight[:, :k]
+        bias = F.linear(x, first.weight[:, k:], first.bias)
+
+        def conditioned(theta: torch.Tensor) -> torch.Tensor:
+            theta = self.normalize(theta)
+            h = F.linear(theta, weight) + bias
+
+            return rest(h.reshape(-1, h.size(-1))).view(h.shape[:-1])
+
+        return conditioned
+
+    def contrast(
+        self,
+        theta: torch.Tensor,  # (N, D)
+        theta_prime: torch.Tensor,  # (N, D) or (K, N, D)
+        x: torch.Tensor,  # (N, *)
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        r"""Ratios of joint and marginal pairs
+
+        (theta, theta', x) ---> (log r(theta | x), log r(theta' | x))
+
+        The parameters are evaluated in a single pass over the concatenated
+        batch, with the contribution of x to the first layer computed once.
+        Batch normalization keeps separate passes, to preserve its statistics.
+        """
+
+        single = theta_prime.dim() == theta.dim()
+        if single:
+            theta_prime = theta_prime[None]
+
+        if any(isinstance(layer, nn.BatchNorm1d) for layer in self.mlp):
+            ratio = self(theta, x)
+            ratio_prime = torch.stack([self(t, x) for t in theta_prime])
+        else:
+            ratios = self.condition(x)(torch.cat([theta[None], theta_prime]))
+            ratio, ratio_prime = ratios[0], ratios[1:]
+
+        if single:
+            ratio_prime = ratio_prime[0]
+
+        return ratio, ratio_prime
+
+
+def stackable(model: nn.Sequential) -> bool:
+    r"""Whether the layers of a model are either linear or parameter-free element-wise"""
+
+    elementwise = tuple(a for a in ACTIVATIONS.values() if a is not nn.PReLU)
+    elementwise += (nn.Dropout, nn.AlphaDropout, nn.Identity)
+
+    return all(
+        isinstance(layer, (nn.Linear,) + elementwise)
+        for layer in model
+    )
+
+
+class StackedLinear(nn.Module):
+    r"""Stacked linear layers
+
+    (*, G, I) ---> (*, G, O)
+
+    Args:
+        layers: The G linear layers, whose weights are stacked.
+    """
+
+    def __init__(self, layers: List[nn.Linear]):
+        super().__init__()
+
+        self.weight = nn.Parameter(torch.stack([l.weight.detach() for l in layers]))
+
+        if layers[0].bias is None:
+            self.register_parameter('bias', None)
+        else:
+            self.bias = nn.Parameter(torch.stack([l.bias.detach() for l in layers]))
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        output = torch.einsum('...gi,goi->...go', input, self.weight)
+
+        if self.bias is not None:
+            output = output + self.bias
+
+        return output
+
+    def select(self, g: int) -> nn.Linear:
+        r"""Linear layer g, whose weights are views of the stacked weights"""
+
+        out_features, in_features = self.weight.shape[1:]
+
+        layer = nn.Linear(in_features, out_features, self.bias is not None, device='meta')
+
+        del layer.weight, layer.bias
+
+        layer.weight = self.weight[g]
+        layer.bias = None if self.bias is None else self.bias[g]
+
+        return layer
+
+
+class StackedNRE(nn.Module):
+    r"""Stacked Neural Ratio Estimators (NRE)
+
+    (theta_a, theta_b, ..., x) ---> (log r(theta_a | x), log r(theta_b | x), ...)
+
+    The G estimators have the same stackable architecture. Their weights are
+    stored stacked, such that each layer is a single batched matrix
+    multiplication, instead of G smaller ones.
+
+    Args:
+        nres: The G estimators, whose weights are stacked.
+    """
+
+    def __init__(self, nres: List[NRE]):
+        super().__init__()
+
+        if isinstance(nres[0].normalize, UnitNorm):
+            self.register_buffer('mu', torch.stack([nre.normalize.mu for nre in nres]))
+            self.register_buffer('isigma', torch.stack([nre.normalize.isigma for nre in nres]))
+        else:
+            self.register_buffer('mu', None)
+            self.register_buffer('isigma', None)
+
+        self.mlp = nn.Sequential(*(
+            StackedLinear(layers) if isinstance(layers[0], nn.Linear) else layers[0]
+            for layers in zip(*(nre.mlp for nre in nres))
+        ))
+
+    def forward(
+        self,
+        theta: torch.Tensor,  # (*, G, k)
+        x: torch.Tensor,  # (*, X)
+    ) -> torch.Tensor:
+        return self.condition(x)(theta)
+
+    def condition(
+        self,
+        x: torch.Tensor,  # (*, X)
+        heads: torch.LongTensor = None,
+    ) -> Callable[[torch.Tensor], torch.Tensor]:
+        r"""Estimators conditioned on a fixed x
+
+        theta (*, G, k) ---> log r(theta | x) (*, G)
+
+        The contribution of x to the first layer is computed once. If `heads`
+        is provided, only these estimators are evaluated.
+        """
+
+        select = lambda t: t if t is None or heads is None else t[heads]
+
+        mu, isigma = select(self.mu), select(self.isigma)
+        stack = [
+            (select(layer.weight), select(layer.bias))
+            if isinstance(layer, StackedLinear) else layer
+            for layer in self.mlp
+        ]
+
+        ## First layer
+        weight, bias = stack[0]
+
+        k = weight.size(-1) - x.size(-1)
+        first = torch.einsum('...i,goi->...go', x, weight[..., k:])
+
+        if bias is not None:
+            first = first + bias
+
+        stack[0] = (weight[..., :k], first)
+
+        def conditioned(theta: torch.Tensor) -> torch.Tensor:
+            h = theta if mu is None else (theta - mu) * isigma
+
+            for layer in stack:
+                if type(layer) is tuple:
+                    weight, bias = layer
+                    h = torch.einsum('...gi,goi->...go', h, weight)
+
+                    if bias is not None:
+                        h = h + bias
+                else:
+                    h = layer(h)
+
+            return h.squeeze(-1)
+
+        return conditioned
+
+    def head(self, g: int) -> NRE:
+        r"""Estimator g, whose weights are views of the stacked weights"""
+
+        nre = NRE.__new__(NRE)  # without allocating weights
+        nn.Module.__init__(nre)
+
+        nre.encoder = nn.Identity()
+
+        if self.mu is None:
+            nre.normalize = nn.Identity()
+        else:
+            nre.normalize = UnitNorm(self.mu[g], self.isigma[g])
+            nre.normalize.isigma = self.isigma[g]
+
+        nre.mlp = nn.Sequential(*(
+            layer.select(g) if isinstance(layer, StackedLinear) else layer
+            for layer in self.mlp
+        ))
+
+        return nre
+
 
 class MNRE(nn.Module):
     r"""Marginal Neural Ratio Estimator (MNRE)
@@ -244,6 +460,8 @@ class MNRE(nn.Module):
         masks: The masks of the considered subsets of the parameters.
         x_size: The size of the (encoded) observations.
         encoder: An optional encoder for the observations.
+        stacked: Whether to evaluate the heads of same size in a single batched
+            pass, with their weights stacked, or one after the other.
 
         **kwargs are transmitted to `NRE`.
     """
@@ -254,6 +472,7 @@ class MNRE(nn.Module):
         x_size: int,
         encoder: nn.Module = nn.Identity(),
         moments: Tuple[torch.Tensor, torch.Tensor] = None,
+        stacked: bool = True,
         **kwargs,
     ) -> torch.Tensor:
         super().__init__()
@@ -265,39 +484,183 @@ class MNRE(nn.Module):
         if moments is not None:
             shift, scale = moments
 
-        self.nres = nn.ModuleList([
+        nres = [
             NRE(
                 m.sum().item(),
                 x_size,
                 moments=None if moments is None else (shift[m], scale[m]),
                 **kwargs,
             ) for m in self.masks
-        ])
+        ]
+
+        # Groups of heads with the same architecture, stacked
+        if stacked and len(nres) > 0 and stackable(nres[0].mlp):
+            sizes = self.masks.sum(dim=-1)
+            self.groups, self.locations = [], [None] * len(nres)
+
+            for i, size in enumerate(sizes.unique().tolist()):
+                heads = (sizes == size).nonzero().squeeze(-1)
+                indices = self.masks[heads].nonzero()[:, 1].view(len(heads), size)
+
+                self.groups.append(heads.tolist())
+                self.register_buffer(f'indices_{i}', indices, persistent=False)
+
+                for g, j in enumerate(heads.tolist()):
+                    self.locations[j] = (i, g)
+
+            order = torch.cat([torch.tensor(heads) for heads in self.groups])
+            self.register_buffer('order', torch.argsort(order), persistent=False)
+
+            self.nres = None
+            self.stacks = nn.ModuleList([
+                StackedNRE([nres[j] for j in heads])
+                for heads in self.groups
+            ])
+        else:
+            self.groups = None
+            self.nres = nn.ModuleList(nres)
+
+    def _load_from_state_dict(self, state_dict: dict, prefix: str, *args, **kwargs):
+        # Heads stored one after the other, as in earlier checkpoints
+        if self.groups is not None and f'{prefix}nres.0.mlp.0.weight' in state_dict:
+            for i, heads in enumerate(self.groups):
+                for name in self.stacks[i].state_dict():
+                    key = {'mu': 'normalize.mu', 'isigma': 'normalize.isigma'}.get(name, name)
+                    state_dict[f'{prefix}stacks.{i}.{name}'] = torch.stack([
+                        state_dict.pop(f'{prefix}nres.{j}.{key}')
+                        for j in heads
+                    ])
+
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def index(self, mask: torch.BoolTensor) -> int:
+        r"""Index of the head of a mask, or `None`"""
 
-    def __getitem__(self, mask: torch.BoolTensor) -> nn.Module:
         mask = mask.to(self.masks)
         match = torch.all(self.masks == mask, dim=-1)
 
         if torch.any(match):
-            i = match.byte().argmax().item()
-            return self.nres[i]
+            return match.byte().argmax().item()
         else:
             return None
 
+    def head(self, j: int) -> nn.Module:
+        if self.groups is None:
+            return self.nres[j]
+
+        i, g = self.locations[j]
+
+        return self.stacks[i].head(g)
+
+    def __getitem__(self, mask: torch.BoolTensor) -> nn.Module:
+        j = self.index(mask)
+
+        return None if j is None else self.head(j)
+
     def __iter__(self) -> Tuple[torch.BoolTensor, nn.Module]:
-        yield from zip(self.masks, self.nres)
+        for j, mask in enumerate(self.masks):
+            yield mask, self.head(j)
 
     def forward(
         self,
-        theta: torch.Tensor,
-        x: torch.Tensor,
+        theta: torch.Tensor,  # (N, D)
+        x: torch.Tensor,  # (N, *)
     ) -> torch.Tensor:
+        if self.groups is None:
+            ratios = []
+
+            for mask, nre in iter(self):
+                ratios.append(nre(theta[..., mask], x))
+
+            return torch.stack(ratios, dim=-1)
+
         ratios = []
 
-        for mask, nre in iter(self):
-            ratios.append(nre(theta[..., mask], x))
+        for i, stack in enumerate(self.stacks):
+            indices = getattr(self, f'indices_{i}')
+            ratios.append(stack(theta[..., indices], x))
+
+        return torch.cat(ratios, dim=-1)[..., self.order]
+
+    def condition(
+        self,
+        x: torch.Tensor,
+        masks: torch.BoolTensor = None,
+    ) -> Callable[[torch.Tensor], torch.Tensor]:
+        r"""Estimators conditioned on a fixed x
+
+        theta ---> (log r(theta_a | x), log r(theta_b | x), ...)
+
+        If masks (G, D) of the same size are provided, only their heads are
+        evaluated, such that theta (*, G, k) ---> (*, G).
+        """
+
+        if masks is not None:
+            heads = [self.index(m) for m in masks]
+
+            if self.groups is None:
+                fs = [self.nres[j].condition(x) for j in heads]
+
+                return lambda theta: torch.stack([
+                    f(theta[..., g, :]) for g, f in enumerate(fs)
+                ], dim=-1)
+
+            i = self.locations[heads[0]][0]
+            positions = torch.tensor([self.locations[j][1] for j in heads], device=x.device)
+
+            return self.stacks[i].condition(x, positions)
+
+        if self.groups is None:
+            heads = [(mask, nre.condition(x)) for mask, nre in iter(self)]
+
+            def conditioned(theta: torch.Tensor) -> torch.Tensor:
+                return torch.stack([f(theta[..., mask]) for mask, f in heads], dim=-1)
+        else:
+            heads = [
+                (getattr(self, f'indices_{i}'), stack.condition(x))
+                for i, stack in enumerate(self.stacks)
+            ]
+
+            def conditioned(theta: torch.Tensor) -> torch.Tensor:
+                ratios = [f(theta[..., indices]) for indices, f in heads]
+                return torch.cat(ratios, dim=-1)[..., self.order]
+
+        return conditioned
+
+    def contrast(
+        self,
+        theta: torch.Tensor,  # (N, D)
+        theta_prime: torch.Tensor,  # (N, D) or (K, N, D)
+        x: torch.Tensor,  # (N, *)
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        r"""Ratios of joint and marginal pairs, for each head
+
+        (theta, theta', x) ---> (log r(theta_a | x), log r(theta'_a | x)), ...
+
+        The parameters are evaluated in a single pass, sharing the
+        contribution of x.
+        """
+
+        if self.groups is None:
+            pairs = [
+                nre.contrast(theta[..., mask], theta_prime[..., mask], x)
+                for mask, nre in iter(self)
+            ]
 
-        return torch.stack(ratios, dim=-1)
+            ratio, ratio_prime = zip(*pairs)
+            return torch.stack(ratio, dim=-1), torch.stack(ratio_prime, dim=-1)
+
+        single = theta_prime.dim() == theta.dim()
+        if single:
+            theta_prime = theta_prime[None]
+
+        ratios = self.condition(x)(torch.cat([theta[None], theta_prime]))
+        ratio, ratio_prime = ratios[0], ratios[1:]
+
+        if single:
+            ratio_prime = ratio_prime[0]
+
+        return ratio, ratio_prime
 
 
 class AMNRE(nn.Module):
@@ -357,14 +720,84 @@ class AMNRE(nn.Module):
         elif self.hyper is not None:
             self.hyper(self.net, mask * 2. - 1.)
 
+        theta = self.embed(theta, mask)
+
+        if self.hyper is None:
+            theta = torch.cat(torch.broadcast_tensors(theta, mask * 2. - 1.), dim=-1)
+
+        return self.net(theta, x)
+
+    def embed(self, theta: torch.Tensor, mask: torch.BoolTensor) -> torch.Tensor:
+        r"""Normalized and masked parameters, in the full parameter space"""
+
         if mask.dim() == 1 and theta.size(-1) < mask.numel():
             blank = theta.new_zeros(theta.shape[:-1] + mask.shape)
             blank[..., mask] = theta
             theta = blank
 
-        theta = self.normalize(theta) * mask
+        return self.normalize(theta) * mask
 
-        if self.hyper is None:
-            theta = torch.cat(torch.broadcast_tensors(theta, mask * 2. - 1.), dim=-1)
+    def context(self, x: torch.Tensor, mask: torch.BoolTensor) -> torch.Tensor:
+        r"""Constant inputs of the network: x and, without hypernetwork, the mask code"""
 
-        return self.net(theta, x)
+        if self.hyper is not None:
+            return x
+
+        code = (mask * 2. - 1.).to(x)
+        batch = torch.broadcast_shapes(code.shape[:-1], x.shape[:-1])
+
+        return torch.cat([
+            code.expand(batch + code.shape[-1:]),
+            x.expand(batch + x.shape[-1:]),
+        ], dim=-1)
+
+    def condition(
+        self,
+        x: torch.Tensor,
+        mask: torch.BoolTensor = None,  # (D,) or (G, D)
+    ) -> Callable[[torch.Tensor], torch.Tensor]:
+        r"""Estimator conditioned on a fixed x and mask
+
+        theta_a ---> log r(theta_a | x)
+
+        Without hypernetwork, the mask is a constant input, whose contribution
+        to the first layer is precomputed along with x's. Several masks (G, D)
+        are then evaluated at once, for parameters (*, G, D) in the full space.
+        Otherwise, the weights are generated once for the mask.
+        """
+
+        if mask is None:
+            mask = self.default
+        elif self.hyper is not None:
+            self.hyper(self.net, mask * 2. - 1.)
+
+        net = self.net.condition(self.context(x, mask))
+
+        def conditioned(theta: torch.Tensor) -> torch.Tensor:
+            return net(self.embed(theta, mask))
+
+        return conditioned
+
+    def contrast(
+        self,
+        theta: torch.Tensor,  # (N, D)
+        theta_prime: torch.Tensor,  # (N, D) or (K, N, D)
+        x: torch.Tensor,  # (N, *)
+        mask: torch.BoolTensor = None,  # (D,) or (N, D)
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        r"""Ratios of joint and marginal pairs
+
+        (theta, theta', x, mask_a) ---> (log r(theta_a | x), log r(theta'_a | x))
+
+        The parameters are evaluated in a single pass, sharing the
+        contribution of x.
+        """
+
+        if mask is None:
+            mask = self.default
+        elif self.hyper is not None:
+            self.hyper(self.net, mask * 2. - 1.)
+
+        theta, theta_prime = self.embed(theta, mask), self.embed(theta_prime, mask)
+
+        return self.net.contrast(theta, theta_prime, self.context(x, mask))
@@ -1,19 +1,22 @@
 #!/usr/bin/env python
 
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.data as data
 
-from itertools import islice
+from functools import partial
+from itertools import count, islice
 from torch.distributions import (
     Distribution,
     Independent,
     Normal,
 )
 
-from typing import Iterable, List, Union
+from typing import Iterable, List, Tuple, Union
 
+from .histograms import grid_cells
 from .simulators import Simulator
 
 
@@ -53,15 +56,57 @@ class NormalTransition(Transition):
 class MetropolisHastings(data.IterableDataset):
     r"""Metropolis-Hastings Algorithm
 
+    The chains are the last batch dimension of x. Leading batch dimensions,
+    if any, are independent groups of chains.
+
+    With leapfrog steps, the proposals follow the Hamiltonian dynamics of
+    log p(x), preconditioned by the proposal covariance. One step amounts to
+    the Metropolis-adjusted Langevin algorithm (MALA). Proposals outside of
+    the support, where log p(x) is not finite, are rejected.
+
+    Args:
+        sigma: The standard deviation of the normal transition.
+        adapt: The number of warm-up steps during which the proposal is
+            adapted. These steps should be discarded.
+        target: The target acceptance rate of the adaptation. If `None`,
+            use 0.234 (random walk), 0.574 (MALA) or 0.65 (HMC).
+        record: The number of chains whose states are recorded after warm-up.
+        leapfrog: The number of leapfrog steps. If 0, use random walk.
+
     Wikipedia:
         https://en.wikipedia.org/wiki/Metropolis%E2%80%93Hastings_algorithm
+        https://en.wikipedia.org/wiki/Hamiltonian_Monte_Carlo
+
+    References:
+        An adaptive Metropolis algorithm
+        (Haario et al., 2001)
+        https://projecteuclid.org/journals/bernoulli/volume-7/issue-2/An-adaptive-Metropolis-algorithm/bj/1080222083.full
+
+        MCMC using Hamiltonian dynamics
+        (Neal, 2011)
+        https://arxiv.org/abs/1206.1901
     """
 
-    def __init__(self, sigma: torch.Tensor = 1.):
+    def __init__(
+        self,
+        sigma: torch.Tensor = 1.,
+        adapt: int = 0,
+        target: float = None,
+        record: int = 0,
+        leapfrog: int = 0,
+    ):
         super().__init__()
 
         self.transition = NormalTransition(sigma)  # q(y | x)
 
+        if target is None:
+            target = 0.234 if leapfrog < 1 else (0.574 if leapfrog == 1 else 0.65)
+
+        self.adapt = adapt
+        self.target = target
+        self.record = record
+        self.leapfrog = leapfrog
+
     def first(self) -> torch.Tensor:
         r""" x_0 """
 
@@ -77,30 +122,107 @@ class MetropolisHastings(data.IterableDataset):
 
         return self.log_prob(x).exp()
 
+    def score(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        r""" (log p(x), grad log p(x)) """
+
+        with torch.enable_grad():
+            x = x.detach().requires_grad_()
+            lp = self.log_prob(x)
+            g, = torch.autograd.grad(lp.sum(), x)
+
+        g = torch.nan_to_num(g, nan=0., posinf=0., neginf=0.)
+
+        return lp.detach(), g
+
+    def hamiltonian(
+        self,
+        x: torch.Tensor,
+        g: torch.Tensor,
+        step: torch.Tensor,
+        tril: torch.Tensor,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        r"""Leapfrog integration from x with a random momentum
+
+        Returns:
+            The end point, its log-density and gradient, and the variation of
+            the kinetic energy.
+        """
+
+        step = step[..., None, None]
+        tril = tril.unsqueeze(-3)
+        triu = tril.transpose(-1, -2)
+
+        r = torch.randn_like(x)
+        k = (r ** 2).sum(dim=-1) / 2
+
+        r = r + step / 2 * (triu @ g.unsqueeze(-1)).squeeze(-1)
+
+        for j in range(self.leapfrog):
+            x = x + step * (tril @ r.unsqueeze(-1)).squeeze(-1)
+            lp, g = self.score(x)
+
+            half = 2 if j + 1 == self.leapfrog else 1
+            r = r + step / half * (triu @ g.unsqueeze(-1)).squeeze(-1)
+
+        return x, lp, g, (r ** 2).sum(dim=-1) / 2 - k
+
+    @property
+    def acceptance(self) -> torch.Tensor:
+        r"""Acceptance rate of each chain after warm-up"""
+
+        return self.accepted / max(self.steps, 1)
+
     def __iter__(self) -> Iterable[torch.Tensor]:
         r""" x_i ~ p(x) """
 
         x = self.first()
 
         # p(x)
-        p_x = self.log_prob(x)
+        if self.leapfrog > 0:
+            p_x, g_x = self.score(x)
+        else:
+            p_x = self.log_prob(x)
 
-        while True:
-            # y ~ q(y | x)
-            y = self.transition(x)
+        # Statistics
+        self.accepted = torch.zeros_like(p_x)
+        self.steps = 0
+        self.history = []
 
-            # p(y)
-            p_y = self.log_prob(y)
+        # Adaptive proposal
+        D = x.shape[-1]
+
+        if self.adapt > 0 or self.leapfrog > 0:
+            sigma = torch.ones_like(x[..., 0, :]) * self.transition.sigma
+
+            tril = torch.diag_embed(sigma)  # Cholesky factor of the covariance
+            log_step = torch.zeros_like(p_x[..., 0])
+        else:
+            tril = None
 
+        for i in count():
             #     p(y)   q(x | y)
             # a = ---- * --------
             #     p(x)   q(y | x)
-            a = p_y - p_x
+            if self.leapfrog > 0:
+                y, p_y, g_y, dk = self.hamiltonian(x, g_x, log_step.exp(), tril)
+                a = p_y - p_x - dk
+            else:
+                # y ~ q(y | x)
+                if tril is None:
+                    y = self.transition(x)
+                else:
+                    eps = torch.randn_like(x).unsqueeze(-1)
+                    y = x + log_step.exp()[..., None, None] * (tril.unsqueeze(-3) @ eps).squeeze(-1)
 
-            if not self.transition.symmetric:
-                a = a + self.transition(y, x) - self.transition(x, y)
+                # p(y)
+                p_y = self.log_prob(y)
 
-            a = a.exp()
+                a = p_y - p_x
+
+                if tril is None and not self.transition.symmetric:
+                    a = a + self.transition(y, x) - self.transition(x, y)
+
+            a = torch.nan_to_num(a, nan=-math.inf).exp()
 
             # u in [0; 1]
             u = torch.rand(a.shape).to(a)
@@ -112,6 +234,30 @@ class MetropolisHastings(data.IterableDataset):
             x = torch.where(mask.unsqueeze(-1), y, x)
             p_x = torch.where(mask, p_y, p_x)
 
+            if self.leapfrog > 0:
+                g_x = torch.where(mask.unsqueeze(-1), g_y, g_x)
+
+            if i < self.adapt:
+                ## Robbins-Monro step size toward the target acceptance rate
+                rate = mask.float().mean(dim=-1)
+                log_step = log_step + (rate - self.target) / (i + 1) ** 0.5
+
+                ## Covariance across chains (Haario et al.), after half of warm-up
+                C = x.shape[-2]
+
+                if i >= self.adapt // 2 and C > D:
+                    mu = x.mean(dim=-2, keepdim=True)
+                    cov = (x - mu).transpose(-1, -2) @ (x - mu) / (C - 1)
+                    cov = cov + torch.diag_embed(cov.diagonal(dim1=-2, dim2=-1) * 1e-6 + 1e-12)
+
+                    tril = torch.linalg.cholesky(cov) * 2.38 / D ** 0.5
+            else:
+                self.accepted = self.accepted + mask
+                self.steps += 1
+
+                if self.record > 0:
+                    self.history.append(x[..., :self.record, :].clone())  # not a view of the chains
+
             yield x
 
     def __call__(
@@ -134,11 +280,11 @@ class MetropolisHastings(data.IterableDataset):
                 buff.append(x)
 
                 if len(buff) == groupby:
-                    yield torch.cat(buff)
+                    yield torch.cat(buff, dim=-2)
                     buff = []
 
             if buff:
-                yield torch.cat(buff)
+                yield torch.cat(buff, dim=-2)
         else:
             yield from seq
 
@@ -158,31 +304,24 @@ class MetropolisHastings(data.IterableDataset):
         if type(bins) is int:
             bins = [bins] * D
 
-        # Create grid
-        volume = 1.  # volume of one cell
-        domains = []
-
-        for l, h, b in zip(low, high, bins):
-            step = (h - l) / b
-            volume = volume * step
+        # Cell volume
+        volume = ((high - low) / torch.tensor(bins).to(low)).prod()
 
-            dom = torch.linspace(l, h - step, b).to(step) + step / 2.
-            domains.append(dom)
+        # Evaluate p(x) on grid, streamed by batches
+        numel = math.prod(bins)
+        p = x.new_empty(numel)
 
-        grid = torch.stack(torch.meshgrid(*domains), dim=-1)
-        grid = grid.view(-1, D).to(x)
+        for start in range(0, numel, B):
+            stop = min(start + B, numel)
+            x = grid_cells(bins, low.to(x), high.to(x), start, stop)
 
-        # Evaluate p(x) on grid
-        p = []
-
-        for x in grid.split(B):
             b = len(x)
             if b < B:
                 x = F.pad(x, (0, 0, 0, B - b))
 
-            p.append(self.prob(x)[:b])
+            p[start:stop] = self.prob(x)[:b]
 
-        p = torch.cat(p).view(bins)
+        p = p.view(bins)
 
         # Scale w.r.t. cell volume
         p = p * volume
@@ -190,21 +329,81 @@ class MetropolisHastings(data.IterableDataset):
         return p
 
 
+def effective_sample_size(x: torch.Tensor) -> torch.Tensor:
+    r"""Effective sample size (ESS) of Markov chains
+
+    Args:
+        x: The states of the chains, with shape (T, *, C, D), where T is the
+            number of steps and C the number of chains.
+
+    Returns:
+        The ESS of each dimension, with shape (*, D).
+
+    References:
+        Stan Reference Manual, Effective Sample Size
+        https://mc-stan.org/docs/reference-manual/effective-sample-size.html
+    """
+
+    T, C = x.size(0), x.size(-2)
+
+    # Autocovariance of each chain
+    means = x.mean(dim=0)
+    y = x - means
+
+    n = 2 ** math.ceil(math.log2(2 * T))
+    f = torch.fft.rfft(y, n=n, dim=0)
+    acov = torch.fft.irfft(f.real ** 2 + f.imag ** 2, n=n, dim=0)[:T] / T
+
+    # Within and between chains variances
+    W = acov[0].mean(dim=-2) * T / (T - 1)
+    B = means.var(dim=-2) if C > 1 else torch.zeros_like(W)
+    var = W * (T - 1) / T + B
+
+    # Autocorrelation
+    rho = 1 - (W - acov.mean(dim=-2)) / var
+
+    # Initial positive sequence
+    K = T // 2
+    pairs = rho[:2 * K].reshape((K, 2) + rho.shape[1:]).sum(dim=1)
+    positive = torch.cumprod((pairs > 0).float(), dim=0)
+
+    tau = -1 + 2 * (pairs * positive).sum(dim=0)
+
+    return C * T / tau.clamp(min=1 / math.log10(C * T + 1))
+
+
 class PosteriorSampler(MetropolisHastings):
-    r"""Posterior Sampler"""
+    r"""Posterior Sampler
+
+    Args:
+        prior: The prior distribution p(theta).
+        x: The observation.
+        batch_size: The number of chains.
+        batched: Whether x is a batch of observations, each with its own
+            chains. If so, the samples have shape (len(x), batch_size, D).
+
+        **kwargs are transmitted to `MetropolisHastings`.
+    """
 
     def __init__(
         self,
         prior: Distribution,
         x: torch.Tensor,
         batch_size: int = 1,
+        batched: bool = False,
         **kwargs
     ):
         super().__init__(**kwargs)
 
         self.prior = prior
-        self.batch_shape = torch.Size((batch_size,))
-        self.x = x.expand(self.batch_shape + x.shape)
+        self.batched = batched
+
+        if batched:
+            self.batch_shape = torch.Size((len(x), batch_size))
+            self.x = x.unsqueeze(1).expand(self.batch_shape + x.shape[1:])
+        else:
+            self.batch_shape = torch.Size((batch_size,))
+            self.x = x.expand(self.batch_shape + x.shape)
 
     def first(self) -> torch.Tensor:
         r""" theta_0 """
@@ -245,7 +444,105 @@ class RESampler(PosteriorSampler):
 
         self.re = re
 
+        # Conditioned on x, if supported
+        if hasattr(re, 'condition'):
+            self.conditioned = re.condition(x.unsqueeze(-2) if self.batched else x)
+        else:
+            self.conditioned = partial(re, x=self.x)
+
     def log_prob(self, theta: torch.Tensor) -> torch.Tensor:
         r""" log p(theta | x) """
 
-        return self.re(theta, self.x) + self.prior.log_prob(theta)
+        return self.conditioned(theta) + self.prior.log_prob(theta)
+
+
+class ImportanceSampler(data.IterableDataset):
+    r"""Importance Sampler, with the prior as proposal
+
+    For a ratio estimator, the importance weights are the ratios
+
+        w = p(theta | x) / p(theta) = r(theta | x).
+
+    The weights are shifted by the running maximum of the log-ratios, which
+    leaves the normalized weights unchanged and never overflows. When the
+    maximum increases, the weights yielded so far should be multiplied by
+    `rescale`, which is `None` otherwise.
+
+    Args:
+        re: The ratio estimator.
+        prior: The prior distribution p(theta).
+        x: The observation.
+        batch_size: The number of samples per batch.
+        batched: Whether x is a batch of observations. If so, the samples
+            have shape (len(x), batch_size, D).
+    """
+
+    def __init__(
+        self,
+        re: nn.Module,
+        prior: Distribution,
+        x: torch.Tensor,
+        batch_size: int = 1,
+        batched: bool = False,
+    ):
+        super().__init__()
+
+        self.re = re
+        self.prior = prior
+
+        if batched:
+            self.batch_shape = torch.Size((len(x), batch_size))
+            x = x.unsqueeze(-2)
+        else:
+            self.batch_shape = torch.Size((batch_size,))
+
+        # Conditioned on x, if supported
+        if hasattr(re, 'condition'):
+            self.conditioned = re.condition(x)
+        else:
+            self.conditioned = partial(re, x=x.expand(self.batch_shape + x.shape[-1:]))
+
+    @property
+    def ess(self) -> torch.Tensor:
+        r"""Effective sample size (ESS) of the weights, per observation"""
+
+        return (2 * self.log_sum_w - self.log_sum_w2).exp()
+
+    def __iter__(self) -> Iterable[Tuple[torch.Tensor, torch.Tensor]]:
+        r""" (theta_i ~ p(theta), w_i) """
+
+        self.shift = None
+
+        while True:
+            theta = self.prior.sample(self.batch_shape)
+            log_w = self.conditioned(theta)
+
+            shift = log_w.max(dim=-1, keepdim=True).values
+
+            if self.shift is None:
+                self.shift = shift
+                self.log_sum_w = torch.full_like(shift[..., 0], -math.inf)
+                self.log_sum_w2 = self.log_sum_w.clone()
+                self.rescale = None
+            elif torch.any(shift > self.shift):
+                shift = torch.maximum(self.shift, shift)
+                delta = (shift - self.shift)[..., 0]
+
+                self.shift = shift
+                self.log_sum_w = self.log_sum_w - delta
+                self.log_sum_w2 = self.log_sum_w2 - 2 * delta
+                self.rescale = (-delta).exp()
+            else:
+                self.rescale = None
+
+            log_w = log_w - self.shift
+
+            self.log_sum_w = torch.logaddexp(self.log_sum_w, log_w.logsumexp(dim=-1))
+            self.log_sum_w2 = torch.logaddexp(self.log_sum_w2, (2 * log_w).logsumexp(dim=-1))
+
+            yield theta, log_w.exp()
+
+    def __call__(self, batches: int) -> Iterable[Tuple[torch.Tensor, torch.Tensor]]:
+        r""" ((theta_0, w_0), ..., (theta_n, w_n)) """
+
+        yield from islice(self, batches)
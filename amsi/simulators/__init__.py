@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import numpy as np
 import torch
 import torch.nn as nn
 
@@ -28,9 +29,27 @@ class Simulator(nn.Module):
     @cached_property
     def labels(self) -> List[str]:  # parameters' labels
         theta_size = self.prior.sample().numel()
-        labels = [f'$\\theta_{{{i}}}$' for i in range(1, theta_size + 1)]
 
-        return labels
+        return default_labels(theta_size)
+
+    @classmethod
+    def bounds(cls) -> Tuple[torch.Tensor, torch.Tensor]:
+        r"""Bounds of the parameters, without instantiation"""
+
+        raise NotImplementedError()
+
+    @classmethod
+    def metadata(cls) -> Tuple[List[str], torch.Tensor, torch.Tensor]:
+        r"""Labels and bounds of the parameters, without instantiation"""
+
+        low, high = cls.bounds()
+
+        if isinstance(cls.labels, list):
+            labels = cls.labels
+        else:
+            labels = default_labels(len(low))
+
+        return labels, low, high
 
     def likelihood(self, theta: torch.Tensor) -> Distribution:
         r""" p(x | theta) """
@@ -57,6 +76,12 @@ class Simulator(nn.Module):
 
         return self.likelihood(theta).sample()
 
+    def reseed(self, seed: int) -> None:
+        r"""Reseeds the random number generators used by the simulator"""
+
+        torch.manual_seed(seed)
+        np.random.seed(seed % 2 ** 32)
+
     def sample(self, sample_shape: torch.Size = ()) -> Tuple[torch.Tensor, torch.Tensor]:
         r""" (theta, x) ~ p(theta) p(x | theta) """
 
@@ -66,6 +91,10 @@ class Simulator(nn.Module):
         return theta, x
 
 
+def default_labels(theta_size: int) -> List[str]:
+    return [f'$\\theta_{{{i}}}$' for i in range(1, theta_size + 1)]
+
+
 class LTERatio(nn.Module):
     r"""Likelihood-to-evidence ratio of tractable simulator"""
 
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 
+import fcntl
 import h5py
+import hashlib
 import inspect
+import json
 import math
 import numpy as np
 import os
+import tempfile
 import torch
 import torch.nn as nn
 
-from functools import cached_property
+from contextlib import contextmanager
 from torch.distributions import (
     Distribution,
     Independent,
@@ -20,6 +24,25 @@ from typing import List, Tuple
 from . import Simulator
 
 
+BOUNDS = torch.tensor([
+    [10., 80.],  # mass1 [solar masses]
+    [.125, 1.],  # mass ratio [/]
+    [0., 2 * math.pi],  # coalesence phase [rad]
+    [-0.1, 0.1],  # coalescence time [s]
+    [100., 1000.],  # luminosity distance [megaparsec]
+    [0., 0.88],  # a_1 [/]
+    [0., 0.88],  # a_2 [/]
+    [0., math.pi],  # tilt_1 [rad]
+    [0., math.pi],  # tilt_2 [rad]
+    [0., 2 * math.pi],  # phi_12 [rad]
+    [0., 2 * math.pi],  # phi_jl [rad]
+    [0., math.pi],  # theta_jn [rad]
+    [0., math.pi],  # polarization [rad]
+    [0., 2 * math.pi],  # right ascension [rad]
+    [-math.pi / 2, math.pi / 2],  # declination [rad]
+])
+
+
 class GW(Simulator):
     r"""Gravitational Waves
 
@@ -35,26 +58,10 @@ class GW(Simulator):
         super().__init__()
 
         # Prior
-        bounds = torch.tensor([
-            [10., 80.],  # mass1 [solar masses]
-            [.125, 1.],  # mass ratio [/]
-            [0., 2 * math.pi],  # coalesence phase [rad]
-            [-0.1, 0.1],  # coalescence time [s]
-            [100., 1000.],  # luminosity distance [megaparsec]
-            [0., 0.88],  # a_1 [/]
-            [0., 0.88],  # a_2 [/]
-            [0., math.pi],  # tilt_1 [rad]
-            [0., math.pi],  # tilt_2 [rad]
-            [0., 2 * math.pi],  # phi_12 [rad]
-            [0., 2 * math.pi],  # phi_jl [rad]
-            [0., math.pi],  # theta_jn [rad]
-            [0., math.pi],  # polarization [rad]
-            [0., 2 * math.pi],  # right ascension [rad]
-            [-math.pi / 2, math.pi / 2],  # declination [rad]
-        ])
-
-        self.register_buffer('low', bounds[:, 0])
-        self.register_buffer('high', bounds[:, 1])
+        low, high = self.bounds()
+
+        self.register_buffer('low', low)
+        self.register_buffer('high', high)
 
         # Simulator
         from .lfigw import waveform_generator as wfg
@@ -78,18 +85,39 @@ class GW(Simulator):
             self.x_star = strain.astype(np.complex64)
 
         ## Basis
-        try:
-            wfd.basis = SVDBasis()
-            wfd.basis.load(path)
+        key = cache_key({
+            'event': 'GW150914',
+            'n_rb': n_rb,
+            'n_ref': n_ref,
+            'approximant': wfd.approximant,
+            'prior': wfd.prior,
+        })
+
+        directory = os.path.join(cache_dir(), 'basis', key)
+
+        if not os.path.isdir(directory):
+            with file_lock(directory + '.lock'):
+                if not os.path.isdir(directory):  # not generated while waiting
+                    wfd.generate_reduced_basis(n_ref, 2 ** 10)
+
+                    temp = tempfile.mkdtemp(dir=os.path.dirname(directory))
+                    wfd.basis.save(temp + os.sep)
+                    os.rename(temp, directory)  # atomic
 
-            assert wfd.basis.n >= n_rb
+        wfd.basis = SVDBasis()
+        wfd.basis.load(directory + os.sep)
+
+        if wfd.basis.n > n_rb:
             wfd.basis.truncate(n_rb)
-        except:
-            wfd.generate_reduced_basis(n_ref, 2 ** 10)
-            wfd.basis.save(path)
 
         self.wfd = wfd
 
+    @classmethod
+    def bounds(cls) -> Tuple[torch.Tensor, torch.Tensor]:
+        r"""Bounds of the parameters, without instantiation"""
+
+        return BOUNDS[:, 0].clone(), BOUNDS[:, 1].clone()
+
     def masked_prior(self, mask: torch.BoolTensor) -> Distribution:
         r""" p(theta_a) """
 
@@ -113,16 +141,13 @@ class GW(Simulator):
 
         return Independent(Joint(marginals), 1)
 
-    @cached_property
-    def labels(self) -> List[str]:
-        labels = [
+    labels = [
+        f'${l}$' for l in [
             'm_1', 'q', r'\phi_c', 't_c', 'd_L',
             'a_1', 'a_2', r'\theta_1', r'\theta_2', r'\phi_{12}', r'\phi_{JL}',
             r'\theta_{JN}', r'\psi', r'\alpha', r'\delta',
         ]
-        labels = [f'${l}$' for l in labels]
-
-        return labels
+    ]
 
     def forward(self, theta: torch.Tensor) -> torch.Tensor:
         r""" x ~ p(x | theta) """
@@ -160,6 +185,38 @@ class GW(Simulator):
         return None, x[None]
 
 
+def cache_dir() -> str:
+    r"""Directory of the cached artifacts, outside of the source tree"""
+
+    default = os.path.join(os.path.expanduser('~'), '.cache', 'amsi')
+    path = os.environ.get('AMSI_CACHE', default)
+
+    os.makedirs(os.path.join(path, 'basis'), exist_ok=True)
+
+    return path
+
+
+def cache_key(config: dict) -> str:
+    r"""Content address of an artifact, from its generation settings"""
+
+    text = json.dumps(config, sort_keys=True, default=str)
+
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+@contextmanager
+def file_lock(filename: str):
+    r"""Exclusive inter-process lock, such that a single job generates an artifact"""
+
+    with open(filename, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 class SuperUniform(Uniform):
     r"""Abstract more-than-uniform distribution"""
 
@@ -3,15 +3,14 @@
 import numpy as np
 import torch
 
-from functools import cached_property
-from multiprocessing import cpu_count
+from multiprocessing import Pool, cpu_count, current_process
 from torch.distributions import (
     Distribution,
     Independent,
     Uniform,
 )
 
-from typing import Tuple, List
+from typing import Tuple
 
 from . import Simulator
 
@@ -19,24 +18,31 @@ from . import Simulator
 class HH(Simulator):
     r"""Hodgkin-Huxley
 
+    The simulations are distributed over a pool of worker processes, each
+    holding its own model. The pool is started lazily, on the first call to
+    `sample`, and persists across calls.
+
+    Args:
+        n_workers: The number of worker processes. If `None`, use all CPUs.
+            If 1 or less, or within a daemonic process, simulate in-process.
+
     References:
         https://github.com/mackelab/IdentifyMechanisticModels_2020/tree/master/5_hh
     """
 
+    block_size = 2 ** 6  # 64
+
     def __init__(self,
         seed: int = 0,
         cython: bool = True,
         n_xcorr: int = 0,
         n_mom: int = 4,
         n_summary: int = 7,
+        n_workers: int = None,
     ):
         super().__init__()
 
-        from delfi.generator import MPGenerator
-
-        from .hhpkg.utils import obs_params, syn_current, syn_obs_data, syn_obs_stats, prior
-        from .hhpkg.HodgkinHuxley import HodgkinHuxley
-        from .hhpkg.HodgkinHuxleyStatsMoments import HodgkinHuxleyStatsMoments
+        from .hhpkg.utils import obs_params, syn_current, syn_obs_data, syn_obs_stats
 
         if cython:
             try:
@@ -48,30 +54,7 @@ class HH(Simulator):
         I, t_on, t_off, dt = syn_current()
         observation = syn_obs_data(I, dt, theta, seed=seed, cython=cython)
 
-        prior = prior(
-            true_params=theta,
-            prior_uniform=True,
-            prior_extent=True,
-            prior_log=False,
-            seed=seed,
-        )
-
-        models = [
-            HodgkinHuxley(
-                I, dt, V0=observation['data'][0],
-                reduced_model=False,
-                prior_log=False,
-                seed=seed + i,
-                cython=cython,
-            ) for i in range(cpu_count())
-        ]
-
-        stats = HodgkinHuxleyStatsMoments(t_on=t_on, t_off=t_off, n_xcorr=n_xcorr, n_mom=n_mom, n_summary=n_summary)
-
-        self.generator = MPGenerator(models=models, prior=prior, summary=stats)
-
-        low = torch.from_numpy(prior.lower).float()
-        high = torch.from_numpy(prior.upper).float()
+        low, high = self.bounds()
 
         self.register_buffer('low', low)
         self.register_buffer('high', high)
@@ -84,23 +67,77 @@ class HH(Simulator):
             seed=seed, cython=cython, n_xcorr=n_xcorr, n_mom=n_mom, n_summary=n_summary,
         )
 
+        # Workers
+        self.config = {
+            'I': I, 'dt': dt, 'V0': observation['data'][0], 'cython': cython,
+            't_on': t_on, 't_off': t_off,
+            'n_xcorr': n_xcorr, 'n_mom': n_mom, 'n_summary': n_summary,
+        }
+
+        self.n_workers = cpu_count() if n_workers is None else n_workers
+        self.pool, self.local = None, None
+
+    def __getstate__(self) -> dict:
+        state = self.__dict__.copy()
+        state['pool'], state['local'] = None, None
+
+        return state
+
+    def __del__(self):
+        if getattr(self, 'pool', None) is not None:
+            self.pool.terminate()
+
     def masked_prior(self, mask: torch.BoolTensor) -> Distribution:
         r""" p(theta_a) """
 
         return Independent(Uniform(self.low[mask], self.high[mask]), 1)
 
-    @cached_property
-    def labels(self) -> List[str]:
-        labels = [r'g_{Na}', 'g_K', 'g_l', 'g_M', r'T_{max}', '-V_T', r'\sigma', '-E_l']
-        labels = [f'${l}$' for l in labels]
+    labels = [
+        f'${l}$' for l in [
+            r'g_{Na}', 'g_K', 'g_l', 'g_M', r'T_{max}', '-V_T', r'\sigma', '-E_l',
+        ]
+    ]
+
+    @classmethod
+    def bounds(cls) -> Tuple[torch.Tensor, torch.Tensor]:
+        r"""Bounds of the parameters, without instantiation"""
+
+        from .hhpkg.utils import obs_params, prior
+
+        theta, _ = obs_params(reduced_model=False)
+        prior = prior(
+            true_params=theta,
+            prior_uniform=True,
+            prior_extent=True,
+            prior_log=False,
+        )
 
-        return labels
+        return torch.from_numpy(prior.lower).float(), torch.from_numpy(prior.upper).float()
 
     def sample(self, sample_shape: torch.Size = ()) -> Tuple[np.ndarray, np.ndarray]:
         r""" (theta, x) ~ p(theta) p(x | theta) """
 
-        numel = torch.Size(sample_shape).numel()
-        theta, x = self.generator.gen(numel, verbose=False)
+        theta = self.prior.sample(sample_shape)
+        theta = theta.reshape(-1, theta.shape[-1]).cpu().numpy()
+
+        # Fixed-size blocks are seeded from the global generator, such that
+        # the simulations do not depend on the number of workers.
+        blocks = [theta[i:i + self.block_size] for i in range(0, len(theta), self.block_size)]
+        seeds = np.random.randint(2 ** 31, size=len(blocks))
+        tasks = list(zip(blocks, seeds))
+
+        if self.n_workers > 1 and not current_process().daemon:
+            if self.pool is None:
+                self.pool = Pool(self.n_workers, init_worker, (self.config,))
+
+            x = self.pool.map(simulate, tasks)
+        else:
+            if self.local is None:
+                self.local = build_worker(self.config)
+
+            x = [simulate(task, self.local) for task in tasks]
+
+        x = np.concatenate(x)
 
         theta = theta.reshape(sample_shape + theta.shape[1:]).astype(np.float32)
         x = x.reshape(sample_shape + x.shape[1:]).astype(np.float32)
@@ -111,3 +148,45 @@ class HH(Simulator):
         r""" (theta*, x*) """
 
         return self.theta_star.astype(np.float32), self.x_star.astype(np.float32)
+
+
+def build_worker(config: dict) -> tuple:
+    r"""Hodgkin-Huxley model and summary statistics"""
+
+    from .hhpkg.HodgkinHuxley import HodgkinHuxley
+    from .hhpkg.HodgkinHuxleyStatsMoments import HodgkinHuxleyStatsMoments
+
+    model = HodgkinHuxley(
+        config['I'], config['dt'], V0=config['V0'],
+        reduced_model=False,
+        prior_log=False,
+        seed=0,
+        cython=config['cython'],
+    )
+
+    stats = HodgkinHuxleyStatsMoments(
+        t_on=config['t_on'], t_off=config['t_off'],
+        n_xcorr=config['n_xcorr'], n_mom=config['n_mom'], n_summary=config['n_summary'],
+    )
+
+    return model, stats
+
+
+worker = None
+
+
+def init_worker(config: dict) -> None:
+    global worker
+
+    worker = build_worker(config)
+
+
+def simulate(task: Tuple[np.ndarray, int], local: tuple = None) -> np.ndarray:
+    r"""Summary statistics of the simulations of a block of parameters"""
+
+    theta, seed = task
+    model, stats = worker if local is None else local
+
+    model.reseed(seed)
+
+    return stats.calc([model.gen_single(t) for t in theta.astype(np.float64)])
@@ -23,8 +23,16 @@ class SLCP(Simulator):
     def __init__(self, lim: float = 3.):
         super().__init__()
 
-        self.register_buffer('low', torch.full((5,), -lim))
-        self.register_buffer('high', torch.full((5,), lim))
+        low, high = self.bounds(lim)
+
+        self.register_buffer('low', low)
+        self.register_buffer('high', high)
+
+    @classmethod
+    def bounds(cls, lim: float = 3.) -> Tuple[torch.Tensor, torch.Tensor]:
+        r"""Bounds of the parameters, without instantiation"""
+
+        return torch.full((5,), -lim), torch.full((5,), lim)
 
     def masked_prior(self, mask: torch.BoolTensor) -> Distribution:
         r""" p(theta_a) """
@@ -60,11 +68,11 @@ class SLCP(Simulator):
 class MLCP(SLCP):
     r"""Mixture Likelihood Complex Posterior"""
 
-    def __init__(self, lim: float = 3.):
-        super().__init__()
+    @classmethod
+    def bounds(cls, lim: float = 3.) -> Tuple[torch.Tensor, torch.Tensor]:
+        r"""Bounds of the parameters, without instantiation"""
 
-        self.register_buffer('low', torch.full((8,), -lim))
-        self.register_buffer('high', torch.full((8,), lim))
+        return torch.full((8,), -lim), torch.full((8,), lim)
 
     def likelihood(self, theta: torch.Tensor, eps: float = 1e-8) -> Distribution:
         r""" p(x | theta) """
@@ -1,8 +1,19 @@
 #!/usr/bin/env python
 
-from train import *
-from torchist import reduce_histogramdd, normalize, marginalize
+import h5py
+import numpy as np
+import os
+import pandas as pd
+import torch
+
+from itertools import chain
+from torchist import normalize, marginalize
 from torchist.metrics import entropy, kl_divergence, w_distance
+from tqdm import tqdm
+
+import amsi
+
+from train import build_instance, load_settings, load_model, Dummy
 
 
 if __name__ == '__main__':
@@ -14,6 +25,7 @@ if __name__ == '__main__':
     parser.add_argument('samples', help='samples file (H5)')
 
     parser.add_argument('-indices', nargs=2, type=int, default=(0, 1), help='indices range')
+    parser.add_argument('-obs-batch', type=int, default=1, help='number of observations evaluated together')
     parser.add_argument('-masks', nargs='+', default=['=1', '=2'], help='marginalization masks')
     parser.add_argument('-filter', default=None, help='mask filter')
 
@@ -21,16 +33,24 @@ if __name__ == '__main__':
     parser.add_argument('-sigma', type=float, default=2e-2, help='relative standard deviation')
     parser.add_argument('-start', type=int, default=2 ** 6, help='start sample')
     parser.add_argument('-stop', type=int, default=2 ** 14, help='end sample')
-    parser.add_argument('-groupby', type=int, default=2 ** 8, help='sample group size')
+    parser.add_argument('-groupby', type=int, default=2 ** 8, help='sample group size (1 updates the histograms at every step)')
+    parser.add_argument('-adapt', type=int, default=0, help='number of adaptive warm-up samples')
+    parser.add_argument('-target', type=float, default=None, help='target acceptance rate')
+    parser.add_argument('-kernel', default='RW', choices=['RW', 'MALA', 'HMC'], help='transition kernel')
+    parser.add_argument('-leapfrog', type=int, default=2 ** 3, help='number of HMC leapfrog steps')
+    parser.add_argument('-ess-chains', type=int, default=2 ** 6, help='number of chains for ESS')
 
     parser.add_argument('-bins', type=int, default=100, help='number of bins')
     parser.add_argument('-mcmc-limit', type=int, default=int(1e7), help='MCMC size limit')
+    parser.add_argument('-method', default='mcmc', choices=['mcmc', 'is'], help='sampling method beyond the MCMC size limit')
     parser.add_argument('-wd-limit', type=int, default=int(1e4), help='Wasserstein distance size limit')
 
     parser.add_argument('-clean', default=False, action='store_true')
 
     parser.add_argument('-accuracy', default=False, action='store_true')
     parser.add_argument('-coverage', default=False, action='store_true')
+    parser.add_argument('-amortized', default=False, action='store_true', help='coverage from prior samples')
+    parser.add_argument('-prior-samples', type=int, default=2 ** 16, help='number of prior samples')
     parser.add_argument('-consistency', default=False, action='store_true')
 
     parser.add_argument('-classify', default=False, action='store_true')
@@ -39,6 +59,9 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    args.start = max(args.start, args.adapt)  # discard warm-up
+    args.leapfrog = {'RW': 0, 'MALA': 1, 'HMC': args.leapfrog}[args.kernel]
+
     torch.set_grad_enabled(False)
 
     # Output
@@ -65,171 +88,288 @@ if __name__ == '__main__':
     else:
         masks = amsi.list2masks(args.masks, theta_size, args.filter)
 
+    if type(model) is amsi.MNRE:
+        masks = masks[[model[mask] is not None for mask in masks]]
+
     # Samples
-    for idx in tqdm(range(*args.indices)):
-        theta_star, x_star = dataset[idx]
+    indices = range(*args.indices)
+    chunks = [indices[i:i + args.obs_batch] for i in range(0, len(indices), args.obs_batch)]
+
+    for chunk in tqdm(chunks):
+        theta_star, x_star = zip(*map(dataset.__getitem__, chunk))
+        x_star = torch.stack(x_star)
+
+        if theta_star[0] is not None:
+            theta_star = torch.stack(theta_star)
 
-        if theta_star is not None:
             index_star = (theta_star - low) / (high - low)
             index_star = (args.bins * index_star).long()
             index_star = index_star.clip(max=args.bins - 1)
             index_star = index_star.cpu()
+        else:
+            theta_star = None
 
         ## Ground truth
-        if args.accuracy and simulator.tractable:
+        truths = {}
+
+        for i, idx in enumerate(chunk):
+            if not (args.accuracy and simulator.tractable):
+                truths[idx] = None
+                continue
+
             pthfile = args.samples.replace('.h5', f'_{idx}.pth')
 
             if not os.path.exists(pthfile):
                 sampler = amsi.TractableSampler(
                     simulator,
-                    x_star,
+                    x_star[i],
                     batch_size=args.batch_size,
                     sigma=args.sigma * (high - low),
+                    adapt=args.adapt,
+                    target=args.target,
+                    leapfrog=args.leapfrog,
                 )
 
-                samples = sampler(args.start, args.stop, groupby=args.groupby)
-                truth = reduce_histogramdd(
-                    samples, args.bins,
-                    low, high,
-                    bounded=True,
-                    sparse=True,
-                    device='cpu',
-                ).coalesce()
+                truth = amsi.Histogram(args.bins, low, high)
+
+                for samples in sampler(args.start, args.stop, groupby=args.groupby):
+                    truth.update(samples)
 
-                truth, _ = normalize(truth)
+                truth, _ = normalize(truth.result().cpu())
 
                 mask = torch.tensor([True] * theta_size)
                 torch.save((mask, truth), pthfile)
             else:
                 _, truth = torch.load(pthfile)
                 truth._coalesced_(True)
-        else:
-            truth = None
+
+            truths[idx] = truth
 
         ## MNRE
-        metrics = []
-        hists = {}
-        divergences = {}
+        metrics = {idx: [] for idx in chunk}
+        hists = {idx: {} for idx in chunk}
+        divergences = {idx: {} for idx in chunk}
+
+        z_star = model.encoder(x_star)
+
+        ### Amortized coverage, without histograms
+        if args.coverage and args.amortized and theta_star is not None:
+            percentiles = amsi.hpd_percentiles(
+                model, z_star, theta_star, masks,
+                simulator.masked_prior,
+                samples=args.prior_samples,
+                batch_size=args.batch_size,
+            )
 
-        z_star = model.encoder(x_star[None])[0]
+            for mask, percentile in percentiles:
+                textmask = amsi.mask2str(mask)
 
-        for mask in masks:
-            textmask = amsi.mask2str(mask)
+                for i, idx in enumerate(chunk):
+                    metrics[idx].append({
+                        'index': idx,
+                        'mask': textmask,
+                        'percentile': percentile[i].item(),
+                    })
+
+            for idx in chunk:
+                df = pd.DataFrame(metrics[idx])
+                df.to_csv(
+                    args.output,
+                    index=False,
+                    mode='a',
+                    header=not os.path.exists(args.output),
+                )
 
-            if type(model) is amsi.NRE:
-                nre = model
-            else:
-                nre = model[mask]
-                if nre is None:
-                    continue
+            continue
 
-            ### Hist
-            numel = args.bins ** torch.count_nonzero(mask).item()
+        ### Grid evaluation of small masks, MCMC otherwise
+        small = torch.tensor([
+            args.bins ** torch.count_nonzero(mask).item() <= args.mcmc_limit
+            for mask in masks
+        ], dtype=bool)
 
-            sampler = amsi.RESampler(
-                nre,
-                simulator.masked_prior(mask),
-                z_star,
+        if torch.any(small):
+            grids = amsi.grid_histograms(
+                model, z_star, masks[small],
+                simulator.masked_prior,
+                args.bins, low, high,
                 batch_size=args.batch_size,
-                sigma=args.sigma * (high[mask] - low[mask]),
             )
+        else:
+            grids = []
 
-            if numel > args.mcmc_limit:
-                samples = sampler(args.start, args.stop, groupby=args.groupby)
-                hist = reduce_histogramdd(
-                    samples, args.bins,
-                    low, high,
-                    bounded=True,
-                    sparse=True,
-                    device='cpu',
-                ).coalesce()
-            else:
-                hist = sampler.histogram(args.bins, low[mask], high[mask])
-                hist = torch.nan_to_num(hist)
+        large = ((mask, None) for mask in masks[~small])
 
-            ### Metrics
-            hist, total = normalize(hist)
+        for mask, batch in chain(grids, large):
+            textmask = amsi.mask2str(mask)
+            numel = args.bins ** torch.count_nonzero(mask).item()
 
-            metrics.append({
-                'index': idx,
-                'mask': textmask,
-                'total_probability': total.item(),
-                'entropy': entropy(hist).item(),
-            })
+            ### Hist
+            if batch is None:
+                nre = model if type(model) is amsi.NRE else model[mask]
 
-            #### Accuracy w.r.t. ground truth
-            if truth is not None:
-                dims = torch.arange(len(mask))[~mask]
-                target = marginalize(truth, dim=dims.tolist())
+                #### Observation index as leading dimension
+                K = len(chunk)
 
-                if not hist.is_sparse:
-                    target = target.to_dense()
+                batch = amsi.Histogram(
+                    [K] + [args.bins] * torch.count_nonzero(mask).item(),
+                    torch.cat([low.new_zeros(1), low[mask]]),
+                    torch.cat([low.new_full((1,), K), high[mask]]),
+                )
+
+                obs = torch.arange(K).to(low) + .5
+
+                def update(samples: torch.Tensor, weights: torch.Tensor = None):
+                    o = obs[:, None, None].expand(samples.shape[:-1] + (1,))
+                    batch.update(torch.cat([o, samples], dim=-1), weights)
 
-                target = target.to(hist)
+                if args.method == 'is':
+                    sampler = amsi.ImportanceSampler(
+                        nre,
+                        simulator.masked_prior(mask),
+                        z_star,
+                        batch_size=args.batch_size,
+                        batched=True,
+                    )
 
-                metrics[-1]['entropy_truth'] = entropy(target).item()
-                metrics[-1]['kl_truth'] = kl_divergence(target, hist).item()
+                    for samples, weights in sampler(args.stop - args.start):
+                        if sampler.rescale is not None:  # the maximum weight increased
+                            batch.rescale(sampler.rescale)
 
-                if numel <= args.wd_limit:
-                    metrics[-1]['wd_truth'] = w_distance(target, hist).item()
+                        update(samples, weights)
+
+                    ess = sampler.ess[:, None]
+                    acceptance = None
                 else:
-                    metrics[-1]['wd_truth'] = None
+                    sampler = amsi.RESampler(
+                        nre,
+                        simulator.masked_prior(mask),
+                        z_star,
+                        batch_size=args.batch_size,
+                        batched=True,
+                        sigma=args.sigma * (high[mask] - low[mask]),
+                        adapt=args.adapt,
+                        target=args.target,
+                        record=args.ess_chains,
+                        leapfrog=args.leapfrog,
+                    )
+
+                    for samples in sampler(args.start, args.stop, groupby=args.groupby):
+                        update(samples)
+
+                    if sampler.history:
+                        ess = amsi.effective_sample_size(torch.stack(sampler.history))
+                        acceptance = sampler.acceptance.mean(dim=-1)
+
+                        sampler.history.clear()
+                    else:
+                        ess = None
 
-                del target
+                batch = batch.result()
+            else:
+                batch = torch.nan_to_num(batch)
+                ess = None
 
-            #### Coverage
-            if args.coverage and theta_star is not None:
-                p = hist[tuple(index_star[mask])]
+            for i, idx in enumerate(chunk):
+                hist = batch[i]
 
                 if hist.is_sparse:
-                    pdf = hist.values()
-                else:
-                    pdf = hist.view(-1)
+                    hist = hist.coalesce()
+
+                ### Metrics
+                hist, total = normalize(hist)
+
+                metrics[idx].append({
+                    'index': idx,
+                    'mask': textmask,
+                    'total_probability': total.item(),
+                    'entropy': entropy(hist).item(),
+                })
+
+                #### Chains diagnostics
+                if ess is not None:
+                    metrics[idx][-1]['ess'] = ess[i].min().item()
+
+                    if acceptance is not None:
+                        metrics[idx][-1]['acceptance'] = acceptance[i].item()
+
+                #### Accuracy w.r.t. ground truth
+                truth = truths[idx]
 
-                metrics[-1]['percentile'] = 1. - pdf[pdf >= p].sum().item()
+                if truth is not None:
+                    dims = torch.arange(len(mask))[~mask]
+                    target = marginalize(truth, dim=dims.tolist())
 
-            #### Consistency
-            hist = hist.cpu()
+                    if not hist.is_sparse:
+                        target = target.to_dense()
 
-            if args.consistency and not hist.is_sparse:
-                divergences[textmask] = {textmask: None}
+                    target = target.to(hist)
 
-                for key, (m, h) in hists.items():
-                    common = torch.logical_and(mask, m)
+                    metrics[idx][-1]['entropy_truth'] = entropy(target).item()
+                    metrics[idx][-1]['kl_truth'] = kl_divergence(target, hist).item()
 
-                    if torch.all(~common):
-                        divergences[textmask][key] = None
-                        divergences[key][textmask] = None
-                        continue
+                    if numel <= args.wd_limit:
+                        metrics[idx][-1]['wd_truth'] = w_distance(target, hist).item()
+                    else:
+                        metrics[idx][-1]['wd_truth'] = None
+
+                    del target
+
+                #### Coverage
+                if args.coverage and theta_star is not None:
+                    p = hist[tuple(index_star[i][mask])]
+
+                    if hist.is_sparse:
+                        pdf = hist.values()
+                    else:
+                        pdf = hist.view(-1)
+
+                    metrics[idx][-1]['percentile'] = 1. - pdf[pdf >= p].sum().item()
 
-                    dims = mask.cumsum(0)[common] - 1
-                    p = marginalize(hist, dim=dims.tolist(), keep=True)
+                #### Consistency
+                hist = hist.cpu()
 
-                    dims = m.cumsum(0)[common] - 1
-                    q = marginalize(h, dim=dims.tolist(), keep=True)
+                if args.consistency and not hist.is_sparse:
+                    divergence = divergences[idx]
+                    divergence[textmask] = {textmask: None}
 
-                    divergences[textmask][key] = w_distance(p, q).item()
-                    divergences[key][textmask] = divergences[textmask][key]
+                    for key, (m, h) in hists[idx].items():
+                        common = torch.logical_and(mask, m)
 
-                hists[textmask] = mask, hist
+                        if torch.all(~common):
+                            divergence[textmask][key] = None
+                            divergence[key][textmask] = None
+                            continue
+
+                        dims = mask.cumsum(0)[common] - 1
+                        p = marginalize(hist, dim=dims.tolist(), keep=True)
+
+                        dims = m.cumsum(0)[common] - 1
+                        q = marginalize(h, dim=dims.tolist(), keep=True)
 
-            ### Export histogram
-            if not args.clean:
-                torch.save((mask, hist), args.output.replace('.csv', f'_{idx}_{textmask}.pth'))
+                        divergence[textmask][key] = w_distance(p, q).item()
+                        divergence[key][textmask] = divergence[textmask][key]
 
-        ## Append metrics
-        df = pd.DataFrame(metrics)
-        df.to_csv(
-            args.output,
-            index=False,
-            mode='a',
-            header=not os.path.exists(args.output),
-        )
+                    hists[idx][textmask] = mask, hist
+
+                ### Export histogram
+                if not args.clean:
+                    torch.save((mask, hist), args.output.replace('.csv', f'_{idx}_{textmask}.pth'))
+
+        for idx in chunk:
+            ## Append metrics
+            df = pd.DataFrame(metrics[idx])
+            df.to_csv(
+                args.output,
+                index=False,
+                mode='a',
+                header=not os.path.exists(args.output),
+            )
 
-        ## Export consistency
-        if args.consistency:
-            df = pd.DataFrame(divergences)
-            df.to_csv(args.output.replace('.csv', f'_{idx}.csv'))
+            ## Export consistency
+            if args.consistency:
+                df = pd.DataFrame(divergences[idx])
+                df.to_csv(args.output.replace('.csv', f'_{idx}.csv'))
 
     # Classification
     if args.classify:
@@ -9,14 +9,10 @@ import matplotlib.pyplot as plt
 import numpy as np
 import os
 import pandas as pd
-import seaborn as sns
 import torch
 import torchist
 import tqdm
 
-from scipy.ndimage import gaussian_filter
-from scipy.stats import kstest
-from sklearn.metrics import roc_curve, auc
 from typing import Dict, List, Tuple, Union
 
 import amsi
@@ -58,7 +54,7 @@ if mpl.checkdep_usetex(True):
 def translate(mask: str) -> str:
     try:
         return ', '.join(
-            l for l, m in zip(simulator.labels, mask)
+            l for l, m in zip(labels, mask)
             if m == '1'
         )
     except:
@@ -156,6 +152,8 @@ def coverage_plot(df: pd.DataFrame) -> mpl.figure.Figure:
 
 
 def consistency_plot(files: List[str], oom: int = -2) -> mpl.figure.Figure:
+    import seaborn as sns
+
     dfs = []
 
     for f in files:
@@ -204,6 +202,8 @@ def consistency_plot(files: List[str], oom: int = -2) -> mpl.figure.Figure:
 
 
 def roc_plot(data: List[np.ndarray]) -> mpl.figure.Figure:
+    from sklearn.metrics import roc_curve, auc
+
     width, _ = plt.rcParams['figure.figsize']
     fig = plt.figure(figsize=(width, width))
 
@@ -430,22 +430,16 @@ if __name__ == '__main__':
         os.makedirs(os.path.dirname(args.output), exist_ok=True)
 
     # Simulator
-    SIMULATORS = {
-        'SLCP': amsi.SLCP,
-        'MLCP': amsi.MLCP,
-        'GW': amsi.GW,
-        'HH': amsi.HH,
-    }
-
     if args.simulator is None:
         file = args.input[0].upper()
 
-        for key in SIMULATORS:
+        for key in amsi.SIMULATORS:
             if key in file:
                 args.simulator = key
                 break
 
-    simulator = SIMULATORS[args.simulator]()
+    labels, low, high = getattr(amsi, args.simulator).metadata()
+    low, high = low.numpy(), high.numpy()
 
     # Loss plots
     if args.type == 'loss':
@@ -554,11 +548,6 @@ if __name__ == '__main__':
         with open(args.input[0]) as f:
             settings = json.load(f)
 
-        ## Simulator
-        labels = simulator.labels
-        low = simulator.low.numpy()
-        high = simulator.high.numpy()
-
         ## Histograms
         data = []
 
@@ -597,6 +586,8 @@ if __name__ == '__main__':
                     h = h.t().cpu().numpy()
 
                     if 'smooth' in item:
+                        from scipy.ndimage import gaussian_filter
+
                         h = gaussian_filter(h, item['smooth'])
 
                     data[-1][(i, j)] = h + data[-1].get((i, j), 0)
@@ -611,7 +602,7 @@ if __name__ == '__main__':
         if 'star' in settings:
             samples, index = settings['star']
 
-            with h5py.File(samples) as f:
+            with amsi.open_samples(samples) as f:
                 star = f['theta'][index]
         else:
             star = None
@@ -5,11 +5,29 @@ import numpy as np
 import os
 import torch
 
+from multiprocessing import Pool
 from tqdm import tqdm
 
 import amsi
 
 
+def build_simulator(name: str, seed: int = 0, n_workers: int = None) -> amsi.Simulator:
+    if name == 'GW':
+        return amsi.GW()
+    elif name == 'HH':
+        return amsi.HH(seed=seed, n_workers=n_workers)
+    elif name == 'MLCP':
+        return amsi.MLCP()
+    else:  # name == 'SCLP'
+        return amsi.SLCP()
+
+
+def chunk_seed(seed: int, i: int) -> int:
+    r"""Seed of the i-th chunk, independent of the number of workers"""
+
+    return int(np.random.SeedSequence([seed, i]).generate_state(1)[0])
+
+
 def gather_chunk(
     simulator: amsi.Simulator,
     chunk_size: int,
@@ -20,20 +38,22 @@ def gather_chunk(
     noisy = noisy and hasattr(simulator, 'noise')
     theta_chunk, x_chunk, noise_chunk = [], [], []
 
-    for _ in range(0, chunk_size, batch_size):
-        theta, x = simulator.sample((batch_size,))
+    for i in range(0, chunk_size, batch_size):
+        size = min(batch_size, chunk_size - i)
+
+        theta, x = simulator.sample((size,))
         theta, x = np.asarray(theta), np.asarray(x)
 
         theta_chunk.append(theta)
         x_chunk.append(x)
 
         if noisy:
-            noise = simulator.noise((batch_size,))
+            noise = simulator.noise((size,))
             noise = np.asarray(noise)
             noise_chunk.append(noise)
 
         if progress is not None:
-            progress.update(batch_size)
+            progress.update(size)
 
     theta_chunk = np.concatenate(theta_chunk)
     x_chunk = np.concatenate(x_chunk)
@@ -42,6 +62,34 @@ def gather_chunk(
     return theta_chunk, x_chunk, noise_chunk
 
 
+worker_simulator = None
+
+
+def init_worker(name: str, seed: int) -> None:
+    global worker_simulator
+
+    torch.set_num_threads(1)
+    worker_simulator = build_simulator(name, seed, n_workers=1)  # already parallel
+
+
+def seeded_chunk(job: tuple, simulator: amsi.Simulator = None) -> tuple:
+    r"""Gathers a chunk after seeding the random number generators
+
+    Args:
+        job: The chunk's seed, size and batch size.
+        simulator: The simulator. If `None`, use the worker's instance.
+    """
+
+    seed, chunk_size, batch_size = job
+
+    if simulator is None:
+        simulator = worker_simulator
+
+    simulator.reseed(seed)
+
+    return gather_chunk(simulator, chunk_size, batch_size)
+
+
 if __name__ == '__main__':
     import argparse
 
@@ -53,13 +101,18 @@ if __name__ == '__main__':
     parser.add_argument('-samples', type=int, default=2 ** 20, help='number of samples')
     parser.add_argument('-chunk-size', type=int, default=2 ** 16, help='chunk size')
     parser.add_argument('-batch-size', type=int, default=2 ** 12, help='batch size')
+    parser.add_argument('-workers', type=int, default=1, help='number of simulation processes')
+    parser.add_argument('-sim-workers', type=int, default=None, help='number of processes per simulator (HH)')
 
     parser.add_argument('-reference', default=None, help='dataset of reference (H5)')
     parser.add_argument('-events', default=False, action='store_true', help='store events')
 
     parser.add_argument('-moments', default=False, action='store_true', help='compute moments')
+    parser.add_argument('-resume', default=False, action='store_true', help='resume incomplete output')
+
+    parser.add_argument('-format', default='h5', choices=['h5', 'mmap'], help='output format')
 
-    parser.add_argument('-o', '--output', default='products/samples/out.h5', help='output file (H5)')
+    parser.add_argument('-o', '--output', default='products/samples/out.h5', help='output file (H5) or directory (mmap)')
 
     args = parser.parse_args()
 
@@ -71,17 +124,13 @@ if __name__ == '__main__':
     torch.manual_seed(args.seed)
 
     # Simulator
-    if args.simulator == 'GW':
-        simulator = amsi.GW()
-    elif args.simulator == 'HH':
-        simulator = amsi.HH(seed=args.seed)
-    elif args.simulator == 'MLCP':
-        simulator = amsi.MLCP()
-    else:  # args.simulator == 'SCLP'
-        simulator = amsi.SLCP()
+    simulator = build_simulator(args.simulator, args.seed, 1 if args.workers > 1 else args.sim_workers)
+
+    # Resume
+    resume = args.resume and os.path.exists(args.output)
 
     # Moments
-    if args.moments:
+    if args.moments and not resume:
         if args.reference is None:
             with tqdm(total=args.chunk_size) as tq:
                 _, x, _ = gather_chunk(simulator, args.chunk_size, args.batch_size, progress=tq)
@@ -89,7 +138,7 @@ if __name__ == '__main__':
             mu = x.mean(axis=0)
             sigma = x.std(axis=0)
         else:
-            with h5py.File(args.reference) as f:
+            with amsi.open_samples(args.reference) as f:
                 mu = f['mu'][:]
                 sigma = f['sigma'][:]
 
@@ -97,9 +146,14 @@ if __name__ == '__main__':
     if os.path.dirname(args.output):
         os.makedirs(os.path.dirname(args.output), exist_ok=True)
 
-    with h5py.File(args.output, 'w') as f:
+    if args.format == 'mmap':
+        File = amsi.MemmapFile
+    else:
+        File = h5py.File
+
+    with File(args.output, 'a' if resume else 'w') as f:
         ## Moments
-        if args.moments:
+        if args.moments and not resume:
             f.create_dataset('mu', data=mu)
             f.create_dataset('sigma', data=sigma)
 
@@ -114,37 +168,75 @@ if __name__ == '__main__':
             exit()
 
         ## Samples
-        theta, x = simulator.sample()
-        theta, x = np.asarray(theta), np.asarray(x)
+        starts = range(0, args.samples, args.chunk_size)
 
-        f.create_dataset(
-            'theta',
-            (args.samples,) + theta.shape,
-            chunks=(args.chunk_size,) + theta.shape,
-            dtype=theta.dtype,
-        )
-
-        f.create_dataset(
-            'x',
-            (args.samples,) + x.shape,
-            chunks=(args.chunk_size,) + x.shape,
-            dtype=x.dtype,
-        )
-
-        if hasattr(simulator, 'noise'):
-            f.create_dataset_like('noise', f['x'])
-
-        with tqdm(total=args.samples) as tq:
-            for i in range(0, args.samples, args.chunk_size):
-                theta, x, noise = gather_chunk(
-                    simulator,
-                    args.chunk_size,
-                    args.batch_size,
-                    progress=tq,
-                )
-
-                f['theta'][i:i + args.chunk_size] = theta
-                f['x'][i:i + args.chunk_size] = x
+        if resume:
+            assert len(f['x']) == args.samples, 'number of samples differs from resumed file'
+            assert f.attrs['chunk_size'] == args.chunk_size, 'chunk size differs from resumed file'
+
+            complete = np.asarray(f.attrs['complete'])
+        else:
+            theta, x = simulator.sample()
+            theta, x = np.asarray(theta), np.asarray(x)
+
+            f.create_dataset(
+                'theta',
+                (args.samples,) + theta.shape,
+                chunks=(args.chunk_size,) + theta.shape,
+                dtype=theta.dtype,
+            )
+
+            f.create_dataset(
+                'x',
+                (args.samples,) + x.shape,
+                chunks=(args.chunk_size,) + x.shape,
+                dtype=x.dtype,
+            )
+
+            if hasattr(simulator, 'noise'):
+                f.create_dataset_like('noise', f['x'])
+
+            ### Ledger of complete chunks
+            complete = np.zeros(len(starts), dtype=bool)
+
+            f.attrs['chunk_size'] = args.chunk_size
+            f.attrs['complete'] = complete
+
+        ## Chunks
+        todo = [c for c in range(len(starts)) if not complete[c]]
+        jobs = [
+            (
+                chunk_seed(args.seed, c),
+                min(args.chunk_size, args.samples - starts[c]),
+                args.batch_size,
+            ) for c in todo
+        ]
+
+        if args.workers > 1:
+            pool = Pool(args.workers, init_worker, (args.simulator, args.seed))
+            chunks = pool.imap(seeded_chunk, jobs)
+        else:
+            pool = None
+            chunks = (seeded_chunk(job, simulator) for job in jobs)
+
+        ## Ordered writes
+        with tqdm(total=args.samples, initial=args.samples - sum(size for _, size, _ in jobs)) as tq:
+            for c, (theta, x, noise) in zip(todo, chunks):
+                i = starts[c]
+                j = i + len(x)
+
+                f['theta'][i:j] = theta
+                f['x'][i:j] = x
 
                 if noise is not None:
-                    f['noise'][i:i + args.chunk_size] = noise
+                    f['noise'][i:j] = noise
+
+                complete[c] = True
+                f.attrs['complete'] = complete
+                f.flush()
+
+                tq.update(len(x))
+
+        if pool is not None:
+            pool.close()
+            pool.join()
@@ -1,20 +1,26 @@
 #!/usr/bin/env python
 
+import copy
 import h5py
 import json
 import os
 import numpy as np
 import pandas as pd
+import random
+import threading
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 import torch.optim as optim
+import torch.utils.data as data
 
 from contextlib import nullcontext
 from datetime import datetime
+from functools import partial
 from itertools import islice
 from time import time
 from tqdm import tqdm
-from typing import List, Tuple
+from typing import Iterable, List, Tuple
 
 import amsi
 
@@ -33,25 +39,39 @@ def build_encoder(input_size: torch.Size, name: str = None, **kwargs) -> tuple:
 
 
 def build_instance(settings: dict) -> tuple:
+    workers = settings.get('workers', 0) > 0  # data is moved to device by the loader
+
     # Simulator
     if settings['simulator'] == 'GW':
         simulator = amsi.GW()
     elif settings['simulator'] == 'HH':
-        simulator = amsi.HH()
+        simulator = amsi.HH(n_workers=1 if workers else settings.get('sim_workers'))
     elif settings['simulator'] == 'MLCP':
         simulator = amsi.MLCP()
     else:  # settings['simulator'] == 'SCLP'
         simulator = amsi.SLCP()
 
+    # Dataset
+    if settings['samples'] is None:
+        dataset = amsi.OnlineDataset(
+            copy.deepcopy(simulator) if workers else simulator,
+            batch_size=settings['bs'],
+        )
+    else:
+        dataset = amsi.OfflineDataset(
+            settings['samples'],
+            batch_size=settings['bs'],
+            device='cpu' if workers else settings['device'],
+            prefetch=settings.get('prefetch', False),
+            device_resident=settings.get('device_resident', False),
+        )
+
     simulator.to(settings['device'])
 
-    # Dataset
     if settings['samples'] is None:
-        dataset = amsi.OnlineDataset(simulator, batch_size=settings['bs'])
         theta, x = simulator.sample()
     else:
-        dataset = amsi.OfflineDataset(settings['samples'], batch_size=settings['bs'], device=settings['device'])
-        theta, x = dataset[0]
+        theta, x = dataset[dataset.ranges[0][0]]  # first complete sample
 
         if theta is None:
             theta = simulator.prior.sample()
@@ -95,9 +115,15 @@ def build_instance(settings: dict) -> tuple:
 
 
 def load_settings(filename: str) -> dict:
+    r"""Settings of a trained network, with in-process and lazy data loading"""
+
     with open(filename) as f:
         settings = json.load(f)
 
+    settings['workers'] = 0
+    settings['prefetch'] = False
+    settings['device_resident'] = False
+
     return settings
 
 
@@ -110,6 +136,103 @@ def load_model(filename: str) -> nn.Module:
     return model
 
 
+def cycle(dataset: data.IterableDataset) -> Iterable:
+    while True:
+        yield from dataset
+
+
+def all_reduce_gradients(optimizer: optim.Optimizer) -> None:
+    r"""Averages the gradients across processes, in a single flat reduction
+
+    Missing gradients are zeros, such that all processes reduce the same
+    buffer.
+    """
+
+    params = [p for group in optimizer.param_groups for p in group['params']]
+
+    for p in params:
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+
+    flat = torch.cat([p.grad.flatten() for p in params])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+
+    for p, g in zip(params, flat.split([p.numel() for p in params])):
+        p.grad.copy_(g.view_as(p))
+
+
+def reduce_moments(losses: torch.Tensor, device: str) -> Tuple[torch.Tensor, torch.Tensor]:
+    r"""Mean and standard deviation of the losses (N, *) of all processes"""
+
+    losses = losses.to(device).double()
+    moments = torch.stack([
+        torch.full_like(losses[0], len(losses)),
+        losses.sum(dim=0),
+        (losses ** 2).sum(dim=0),
+    ])
+
+    dist.all_reduce(moments)
+
+    n, s1, s2 = moments
+    mean = s1 / n
+    std = ((s2 - n * mean ** 2) / (n - 1)).clamp(min=0).sqrt()
+
+    return mean.float().cpu(), std.float().cpu()
+
+
+def rng_states() -> dict:
+    r"""States of the random number generators of the process"""
+
+    return {
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+        'numpy': np.random.get_state(),
+        'python': random.getstate(),
+    }
+
+
+def set_rng_states(states: dict) -> None:
+    torch.set_rng_state(states['torch'])
+
+    if states['cuda']:
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+    np.random.set_state(states['numpy'])
+    random.setstate(states['python'])
+
+
+def host_copy(state):
+    r"""Copy of a (nested) state, with its tensors on host"""
+
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        return {k: host_copy(v) for k, v in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(host_copy(v) for v in state)
+    else:
+        return copy.deepcopy(state)
+
+
+def save_async(state: dict, filename: str) -> threading.Thread:
+    r"""Writes a state in a background thread
+
+    The state is written to a temporary file, which is then renamed, such that
+    an interrupted write never corrupts the previous file.
+    """
+
+    def write():
+        temp = filename + '.tmp'
+        torch.save(state, temp)
+        os.replace(temp, filename)
+
+    thread = threading.Thread(target=write)
+    thread.start()
+
+    return thread
+
+
 class Dummy(nn.Module):
     def __getitem__(self, idx):
         return None
@@ -120,6 +243,9 @@ class Dummy(nn.Module):
     def encoder(self, *args):
         return None
 
+    def condition(self, *args):
+        return self
+
 
 if __name__ == '__main__':
     import argparse
@@ -129,6 +255,10 @@ if __name__ == '__main__':
     parser.add_argument('-device', default='cpu', choices=['cpu', 'cuda'])
     parser.add_argument('-simulator', default='SLCP', choices=['SLCP', 'MLCP', 'GW', 'HH'])
     parser.add_argument('-samples', default=None, help='samples file (H5)')
+    parser.add_argument('-prefetch', default=False, action='store_true', help='prefetch samples chunks')
+    parser.add_argument('-workers', type=int, default=0, help='number of data loading processes')
+    parser.add_argument('-sim-workers', type=int, default=None, help='number of simulation processes (HH)')
+    parser.add_argument('-device-resident', default=False, action='store_true', help='load samples on device once')
     parser.add_argument('-model', type=json.loads, default={}, help='model architecture')
     parser.add_argument('-hyper', type=json.loads, default=None, help='hypernet architecture')
     parser.add_argument('-encoder', type=json.loads, default={}, help='encoder architecture')
@@ -141,6 +271,7 @@ if __name__ == '__main__':
     parser.add_argument('-adversary', default=None, help='adversary network file (PTH)')
     parser.add_argument('-distillation', default=None, help='distillation network file (PTH)')
     parser.add_argument('-lambdas', type=float, nargs=2, default=(1e-3, 1e-3), help='auxiliary losses weights')
+    parser.add_argument('-negatives', type=int, default=1, help='marginal parameters per observation (-1 for all in-batch)')
 
     parser.add_argument('-epochs', type=int, default=256, help='number of epochs')
     parser.add_argument('-per-epoch', type=int, default=256, help='batches per epoch')
@@ -153,22 +284,56 @@ if __name__ == '__main__':
     parser.add_argument('-factor', type=float, default=5e-1, help='scheduler factor')
     parser.add_argument('-min-lr', type=float, default=1e-6, help='minimum learning rate')
     parser.add_argument('-clip', type=float, default=1e2, help='gradient norm')
+    parser.add_argument('-precision', default='fp32', choices=['fp32', 'tf32', 'bf16', 'fp16'], help='forward passes precision')
+    parser.add_argument('-compile', default=False, action='store_true', help='compile the forward graph (losses and their gradients)')
+    parser.add_argument('-seed', type=int, default=None, help='random seed')
+    parser.add_argument('-checkpoint', type=int, default=0, help='epochs between checkpoints (0 to disable)')
+    parser.add_argument('-resume', default=False, action='store_true', help='resume from the checkpoint, if any')
 
     parser.add_argument('-valid', default=None, help='validation samples file (H5)')
 
     parser.add_argument('-o', '--output', default='products/models/out.pth', help='output file (PTH)')
 
     args = parser.parse_args()
+
+    if args.precision in ['tf32', 'fp16'] and args.device != 'cuda':
+        parser.error(f'{args.precision} precision requires a CUDA device')
+
     args.date = datetime.now().strftime(r'%Y-%m-%d %H:%M:%S')
 
+    # Distributed (torchrun)
+    rank = int(os.environ.get('RANK', 0))
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    distributed = world_size > 1
+
+    if distributed:
+        dist.init_process_group('nccl' if args.device == 'cuda' else 'gloo')
+
+        if args.device == 'cuda':
+            torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', 0)))
+
+    if distributed and args.sim_workers is None:  # share the node's cores
+        local_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+        args.sim_workers = max(1, os.cpu_count() // local_size)
+
+    if args.seed is not None or distributed:  # distinct streams across processes
+        seed = torch.initial_seed() if args.seed is None else args.seed
+
+        torch.manual_seed(seed + rank)
+        np.random.seed((seed + rank) % 2 ** 32)
+
     # Output directory
-    if os.path.dirname(args.output):
+    if rank == 0 and os.path.dirname(args.output):
         os.makedirs(os.path.dirname(args.output), exist_ok=True)
 
     # Simulator & Model
     settings = vars(args)
     simulator, dataset, model = build_instance(settings)
 
+    if distributed:  # same initial weights
+        for t in model.state_dict().values():
+            dist.broadcast(t, 0)
+
     ## Arbitrary masks
     if args.arbitrary:
         theta_size = simulator.prior.sample().numel()
@@ -231,6 +396,7 @@ if __name__ == '__main__':
         lr=args.lr,
         weight_decay=args.weight_decay,
         amsgrad=args.amsgrad,
+        fused=args.compile and args.device == 'cuda',
     )
 
     scheduler = amsi.ReduceLROnPlateau(
@@ -241,82 +407,200 @@ if __name__ == '__main__':
         min_lr=args.min_lr,
     )
 
+    # Precision
+    if args.precision in ['fp32', 'tf32']:
+        autocast = nullcontext
+
+        if args.precision == 'tf32':  # TensorFloat-32 matrix products and convolutions
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+    else:
+        dtype = torch.bfloat16 if args.precision == 'bf16' else torch.float16
+        autocast = partial(torch.autocast, args.device, dtype=dtype)
+
+    scaler = torch.cuda.amp.GradScaler(enabled=args.precision == 'fp16')
+
     # Datasets
-    trainset = amsi.LTEDataset(dataset)
+    checkpoint = args.checkpoint > 0 or args.resume
+
+    if (distributed or checkpoint) and isinstance(dataset, amsi.OfflineDataset):
+        dataset.shard(rank, world_size, seed=args.seed or 0)
+
+    trainset = amsi.LTEDataset(dataset, negatives=args.negatives)
+
+    if args.workers > 0:
+        trainset = data.DataLoader(
+            trainset,
+            batch_size=None,
+            num_workers=args.workers,
+            pin_memory=args.device == 'cuda',
+            persistent_workers=getattr(dataset, 'seed', None) is not None,  # seeded passes are counted by the workers
+        )
+
+    trainset = cycle(trainset)
 
     if args.valid is not None:
-        validset = amsi.LTEDataset(amsi.OfflineDataset(args.valid, batch_size=args.bs, device=args.device))
+        validdata = amsi.OfflineDataset(args.valid, batch_size=args.bs, device=args.device)
+
+        if distributed or checkpoint:
+            validdata.shard(rank, world_size, seed=args.seed or 0)
+
+        validset = amsi.LTEDataset(validdata)
 
     # Routine
-    def routine(dataset, optimize: bool = True) -> Tuple[float, torch.Tensor]:
-        losses = []
+    def step(theta: torch.Tensor, theta_prime: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+        if args.arbitrary:
+            if model.hyper is None:
+                mask = mask_sampler(theta.shape[:1])
+            else:
+                mask = mask_sampler()
+                model[mask]
+                adversary[mask]
+                mask = None
 
-        start = time()
+            extra = (mask,)
+        else:
+            extra = ()
 
-        for theta, theta_prime, x in islice(dataset, args.per_epoch):
-            theta.requires_grad = True
+        with autocast():
             z = model.encoder(x)
             adv_z = adversary.encoder(x)
 
-            if args.arbitrary:
-                if model.hyper is None:
-                    mask = mask_sampler(theta.shape[:1])
-                else:
-                    mask = mask_sampler()
-                    model[mask]
-                    adversary[mask]
-                    mask = None
+            if targetnet is None:
+                ratio, ratio_prime = model.contrast(theta, theta_prime, z, *extra)
+            else:
+                ratio_prime = model.condition(z, *extra)(theta_prime)
 
-                ratio = model(theta, z, mask)
-                ratio_prime = model(theta_prime, z, mask)
+            adv_ratio_prime = adversary.condition(adv_z, *extra)(theta_prime)
 
-                adv_ratio_prime = adversary(theta_prime, adv_z, mask)
-            else:
-                ratio = model(theta, z)
-                ratio_prime = model(theta_prime, z)
+        ## Losses in full precision
+        if targetnet is not None:  # score regression differentiates w.r.t. theta
+            ratio = model(theta, z.float(), *extra)
+
+        ratio, ratio_prime = ratio.float(), ratio_prime.float()
 
-                adv_ratio_prime = adversary(theta_prime, adv_z)
+        if adv_ratio_prime is not None:
+            adv_ratio_prime = adv_ratio_prime.float().exp()
 
-            if adv_ratio_prime is not None:
-                adv_ratio_prime = adv_ratio_prime.exp()
+        ## Negatives along the batch
+        if theta_prime.dim() > theta.dim():  # (K, N, D)
+            negatives = lambda t: t if t is None else t.flatten(0, 1)
+        else:
+            negatives = lambda t: t
+
+        l = criterion(ratio) + criterion(-negatives(ratio_prime), negatives(adv_ratio_prime))
 
-            l = criterion(ratio) + criterion(-ratio_prime, adv_ratio_prime)
+        if targetnet is not None:
+            target_z = targetnet.encoder(x)
 
-            if targetnet is not None:
-                target_z = targetnet.encoder(x)
+            if hasattr(targetnet, 'contrast'):
+                target_ratio, target_ratio_prime = targetnet.contrast(theta, theta_prime, target_z)
+            else:
                 target_ratio = targetnet(theta, target_z)
                 target_ratio_prime = targetnet(theta_prime, target_z)
 
-                l_rr = args.lambdas[0] * rr_loss(ratio_prime, target_ratio_prime)
-                l_irr = args.lambdas[0] * rr_loss(-ratio, -target_ratio)
-                l_sr = args.lambdas[1] * sr_loss(theta, ratio, target_ratio)
+            l_rr = args.lambdas[0] * rr_loss(negatives(ratio_prime), negatives(target_ratio_prime))
+            l_irr = args.lambdas[0] * rr_loss(-ratio, -target_ratio)
+            l_sr = args.lambdas[1] * sr_loss(theta, ratio, target_ratio)
+
+            l = torch.stack([l, l_rr, l_irr, l_sr])
+
+        return l
+
+    ## Compilation
+    if args.compile:
+        eager = [
+            (targetnet is not None, 'score regression needs double backward'),
+            (args.arbitrary and model.hyper is not None, 'hypernetworks reparametrize in place'),
+            (args.arbitrary and isinstance(mask_sampler, amsi.PoissonMask), 'Poisson masks are sampled on host'),
+        ]
+
+        reasons = [reason for cond, reason in eager if cond]
+
+        if reasons:
+            print('Compilation disabled:', ', '.join(reasons))
+        else:  # forward graph only, the optimizer step stays eager (fused on CUDA)
+            step = torch.compile(step, mode='reduce-overhead')
+
+    def routine(dataset, optimize: bool = True) -> Tuple[float, torch.Tensor]:
+        losses = []
+
+        start = time()
+
+        for theta, theta_prime, x in islice(dataset, args.per_epoch):
+            theta, theta_prime, x = (
+                t.to(args.device, non_blocking=True)
+                for t in (theta, theta_prime, x)
+            )
+
+            theta.requires_grad = True
 
-                l = torch.stack([l, l_rd, l_ird, l_sd])
+            l = step(theta, theta_prime, x)
 
-            losses.append(l.tolist())
+            losses.append(l.detach().clone())  # compiled outputs are overwritten
 
             if optimize:
                 optimizer.zero_grad()
-                l.sum().backward()
+                scaler.scale(l.sum()).backward()
+
+                if distributed:
+                    all_reduce_gradients(optimizer)
+
+                scaler.unscale_(optimizer)
                 nn.utils.clip_grad_norm_(model.parameters(), args.clip)
-                optimizer.step()
+                scaler.step(optimizer)
+                scaler.update()
+
+        losses = torch.stack(losses).cpu()
 
         end = time()
 
-        return end - start, torch.tensor(losses)
+        return end - start, losses
 
-    # Training
-    stats = []
+    # Resume
+    ckptfile = args.output.replace('.pth', '.ckpt')
+    stats, start, writer = [], 1, None
+
+    if args.resume and os.path.isfile(ckptfile):
+        state = torch.load(ckptfile, map_location='cpu')
+
+        assert len(state['rng']) == world_size, "the checkpoint was written by another number of processes"
+
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+
+        if scaler.is_enabled():
+            scaler.load_state_dict(state['scaler'])
+
+        stats, start = state['stats'], state['epoch'] + 1
+
+        ## Dataset position
+        if isinstance(dataset, amsi.OfflineDataset):
+            dataset.seek(state['batches'], args.workers)
+
+        if args.valid is not None:
+            validdata.epoch = state['valid']
+
+        set_rng_states(state['rng'][rank])
 
-    for epoch in tqdm(range(1, args.epochs + 1)):
+    # Training
+    for epoch in tqdm(
+        range(start, args.epochs + 1),
+        initial=start - 1,
+        total=args.epochs,
+        disable=rank > 0,
+    ):
         timing, losses = routine(trainset)
 
+        mean, std = reduce_moments(losses, args.device) if distributed else (losses.mean(dim=0), losses.std(dim=0))
+
         stats.append({
             'epoch': epoch,
             'time': timing,
             'lr': scheduler.lr,
-            'mean': losses.mean(dim=0).tolist(),
-            'std': losses.std(dim=0).tolist(),
+            'mean': mean.tolist(),
+            'std': std.tolist(),
         })
 
         if args.valid is not None:
@@ -327,30 +611,66 @@ if __name__ == '__main__':
 
             model.train()
 
+            v_mean, v_std = reduce_moments(v_losses, args.device) if distributed else (v_losses.mean(dim=0), v_losses.std(dim=0))
+
             stats[-1].update({
-                'v_mean': v_losses.mean(dim=0).tolist(),
-                'v_std': v_losses.std(dim=0).tolist(),
+                'v_mean': v_mean.tolist(),
+                'v_std': v_std.tolist(),
             })
 
-            scheduler.step(v_losses.mean())
+            scheduler.step(v_mean.mean())
         else:
-            scheduler.step(losses.mean())
+            scheduler.step(mean.mean())
 
         if scheduler.plateau:
-            df = pd.DataFrame(stats)
-            df.to_csv(args.output.replace('.pth', '.csv'), index=False)
+            if rank == 0:
+                df = pd.DataFrame(stats)
+                df.to_csv(args.output.replace('.pth', '.csv'), index=False)
 
             if scheduler.bottom:
                 break
 
-    # Outputs
+        ## Checkpoint
+        if args.checkpoint > 0 and epoch % args.checkpoint == 0:
+            if distributed:
+                rng = [None] * world_size
+                dist.all_gather_object(rng, rng_states())
+            else:
+                rng = [rng_states()]
 
-    ## Weights
-    if hasattr(model, 'clear'):
-        model.clear()
+            if rank == 0:
+                df = pd.DataFrame(stats)
+                df.to_csv(args.output.replace('.pth', '.csv'), index=False)
+
+                if writer is not None:  # one write at a time
+                    writer.join()
+
+                writer = save_async(host_copy({
+                    'model': model.state_dict(),
+                    'optimizer': optimizer.state_dict(),
+                    'scheduler': scheduler.state_dict(),
+                    'scaler': scaler.state_dict(),
+                    'stats': stats,
+                    'epoch': epoch,
+                    'batches': epoch * args.per_epoch,
+                    'valid': validdata.epoch if args.valid is not None else None,
+                    'rng': rng,
+                }), ckptfile)
+
+    if writer is not None:
+        writer.join()
+
+    if distributed:
+        dist.destroy_process_group()
+
+    # Outputs
+    if rank == 0:
+        ## Weights
+        if hasattr(model, 'clear'):
+            model.clear()
 
-    torch.save(model.cpu().state_dict(), args.output)
+        torch.save(model.cpu().state_dict(), args.output)
 
-    ## Settings
-    with open(args.output.replace('.pth', '.json'), 'w') as f:
-        json.dump(settings, f, indent=4)
+        ## Settings
+        with open(args.output.replace('.pth', '.json'), 'w') as f:
+            json.dump(settings, f, indent=4)